@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), 'gitlab_stats'))
+
+import gitlab_stats
+from fake_sinks import MemoryInfluxDBStore, MemoryTimestreamStore, SinkStats
+from metrics_store_influx import InfluxDBMetricsProcessor
+from metrics_store_ts import TimestreamMetricsProcessor
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+# The fake API sends no rate limit headers, the limiter would otherwise pace it at its initial rate.
+DEFAULT_PIPELINE_ARGS = ['--api-initial-rate', '100000', '--api-burst', '100000']
+# Fake API of each site type, the github site types share one serving both REST and GraphQL.
+FAKE_SERVERS = {'gitlab': 'fake_gitlab.py', 'github': 'fake_github.py', 'github-graphql': 'fake_github.py'}
+SCENARIOS = {
+    'small': {'projects': 20, 'commits': 100},
+    'medium': {'projects': 10, 'commits': 2000},
+    'large': {'projects': 2, 'commits': 20000},
+    'branches': {'projects': 5, 'commits': 1000, 'branches': 20, 'branch_commits': 25},
+}
+
+
+class StageTimer:
+    """Time spent in each stage, summed over the threads that ran it."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.calls = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def timed(self, stage, function):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return wrapper
+
+    def timed_generator(self, stage, function):
+        """Times each step of a generator, as fetch_commits and process_commit do their work lazily."""
+        def wrapper(*args, **kwargs):
+            iterator = iter(function(*args, **kwargs))
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+                yield item
+        return wrapper
+
+    def as_dict(self):
+        return {stage: round(seconds, 4) for stage, seconds in sorted(self.seconds.items())}
+
+
+class BenchmarkContext(gitlab_stats.Context):
+    """The pipeline's context with in-memory sinks and timed fetchers, processors and stores."""
+    def __init__(self, args, sink, sink_latency, timer, stats):
+        self.sink = sink
+        self.sink_latency = sink_latency
+        self.timer = timer
+        self.stats = stats
+        super().__init__(args)
+
+    @property
+    def metrics_fetcher(self):
+        if not hasattr(self.local, 'metrics_fetcher'):
+            fetcher = gitlab_stats.Context.metrics_fetcher.fget(self)
+            fetcher.fetch_projects = self.timer.timed('fetch_projects', fetcher.fetch_projects)
+            fetcher.fetch_commits = self.timer.timed_generator('fetch_commits', fetcher.fetch_commits)
+        return self.local.metrics_fetcher
+
+    def build_store(self):
+        if self.sink == 'timestream':
+            store = MemoryTimestreamStore(self.stats, self.sink_latency, self.args.ts_write_concurrency)
+            processor = TimestreamMetricsProcessor(store, self.args.multi_measure, self.preloaded, self.team_index)
+        else:
+            store = MemoryInfluxDBStore(self.stats, self.sink_latency, self.args.influxdb_write_mode,
+                                        self.args.influxdb_batch_size, self.args.influxdb_flush_interval,
+                                        self.args.influxdb_max_inflight)
+            processor = InfluxDBMetricsProcessor(store, self.args.multi_measure, self.preloaded, self.team_index)
+        store.submit_records = self.timer.timed('write_records', store.submit_records)
+        store.flush = self.timer.timed('flush', store.flush)
+        processor.process_commit = self.timer.timed_generator('process_commit', processor.process_commit)
+        return store, processor
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark gitlab_stats ingestion against a fake GitLab or GitHub API and in-memory sinks',
+                                     epilog='Arguments after -- are passed to gitlab_stats, e.g. -- --multi-measure -w 8')
+    parser.add_argument('-S', '--scenario', required=False, action='append', choices=sorted(SCENARIOS), help='Scenario to run, all of them by default')
+    parser.add_argument('--fetcher', required=False, choices=sorted(FAKE_SERVERS), help='Site type to fetch with, against the fake API of its site', default='gitlab')
+    parser.add_argument('--sink', required=False, choices=['timestream', 'influxdb'], help='In-memory sink standing in for the store', default='timestream')
+    parser.add_argument('--latency', required=False, type=float, help='Seconds added to each fake API call', default=0.0)
+    parser.add_argument('--sink-latency', required=False, type=float, help='Seconds added to each write request of the sink', default=0.0)
+    parser.add_argument('--page-size', required=False, type=int, help='Items per page of the fake API', default=20)
+    parser.add_argument('-o', '--output-dir', required=False, help='Directory the results are saved to', default=os.path.join(BENCHMARK_DIR, 'results'))
+    parser.add_argument('--compare', required=False, help='Results file of an earlier run to compare with')
+    parser.add_argument('--run-one', required=False, help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', required=False, help=argparse.SUPPRESS)
+    args, pipeline_args = parser.parse_known_args()
+    if pipeline_args[:1] == ['--']:
+        pipeline_args = pipeline_args[1:]
+    return args, pipeline_args
+
+
+def run_one(args, pipeline_args):
+    """Runs one scenario in this process, so its peak RSS is the pipeline's own."""
+    site_args = ['-u', args.api_url] if args.fetcher == 'gitlab' else ['--github-url', args.api_url]
+    pipeline_args = gitlab_stats.parse_arguments(['-k', 'benchmark', '--site-type', args.fetcher, '-c', 'benchmark',
+                                                  '-a', 'benchmark', '-s', 'benchmark', '-d', 'benchmark']
+                                                 + site_args + DEFAULT_PIPELINE_ARGS + pipeline_args)
+    timer, stats = StageTimer(), SinkStats()
+    started = time.perf_counter()
+    with BenchmarkContext(pipeline_args, args.sink, args.sink_latency, timer, stats) as context:
+        summary = gitlab_stats.run(pipeline_args, context)
+    elapsed = time.perf_counter() - started
+    result = {
+        'seconds': round(elapsed, 4),
+        'failed_projects': len(summary.failures) if summary else 0,
+        'stage_seconds': timer.as_dict(),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        **stats.as_dict()
+    }
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_stats(url):
+    with urllib.request.urlopen(f"{url}/_stats", timeout=5) as response:
+        return json.load(response)
+
+
+def run_scenario(name, args, pipeline_args):
+    scenario = SCENARIOS[name]
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, FAKE_SERVERS[args.fetcher]), '--port', str(port),
+                               '--projects', str(scenario['projects']), '--commits', str(scenario['commits']),
+                               '--branches', str(scenario.get('branches', 0)),
+                               '--branch-commits', str(scenario.get('branch_commits', 10)),
+                               '--latency', str(args.latency), '--page-size', str(args.page_size)],
+                              stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                server_stats(url)
+                break
+            except OSError:
+                time.sleep(0.1)
+        if scenario.get('branches'):
+            pipeline_args = ['-b', 'true'] + pipeline_args
+        command = [sys.executable, os.path.abspath(__file__), '--run-one', name, '--fetcher', args.fetcher, '--api-url', url,
+                   '--sink', args.sink, '--sink-latency', str(args.sink_latency), '--'] + pipeline_args
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        result = json.loads(next(line[len(RESULT_PREFIX):] for line in output.splitlines()
+                                 if line.startswith(RESULT_PREFIX)))
+        api = server_stats(url)
+    finally:
+        server.terminate()
+        server.wait()
+
+    commits = result['commits']
+    result.update({
+        'scenario': scenario,
+        'api_calls': api['requests'],
+        'api_bytes': api['bytes'],
+        'commits_per_sec': round(commits / result['seconds'], 1) if result['seconds'] else None,
+        'api_calls_per_commit': round(api['requests'] / commits, 4) if commits else None
+    })
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline.get('revision')} ({baseline_file}):")
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric in ('commits_per_sec', 'api_calls_per_commit', 'peak_rss_mb'):
+            if before.get(metric) and result.get(metric) is not None:
+                changes.append(f"{metric} {before[metric]} -> {result[metric]} "
+                               f"({(result[metric] - before[metric]) / before[metric] * 100:+.1f}%)")
+        print(f"\t{name}: " + ', '.join(changes))
+
+
+def main():
+    args, pipeline_args = parse_arguments()
+    if args.run_one:
+        run_one(args, pipeline_args)
+        return
+
+    results = {
+        'revision': git_revision(),
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'settings': {'fetcher': args.fetcher, 'sink': args.sink, 'latency': args.latency, 'sink_latency': args.sink_latency,
+                     'page_size': args.page_size, 'pipeline_args': pipeline_args},
+        'scenarios': {}
+    }
+    for name in args.scenario or sorted(SCENARIOS):
+        result = results['scenarios'][name] = run_scenario(name, args, pipeline_args)
+        print(f"{name}: {result['commits']} commits in {result['seconds']}s, {result['commits_per_sec']} commits/s, "
+              f"{result['api_calls_per_commit']} API calls per commit, peak RSS {result['peak_rss_mb']} MB, "
+              f"stages {result['stage_seconds']}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output = os.path.join(args.output_dir, f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{results['revision']}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
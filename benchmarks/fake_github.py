@@ -0,0 +1,185 @@
+import json
+import time
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+from fake_gitlab import FakeGitLabHandler, FakeGitLabServer, SyntheticRepositories, parse_arguments
+
+OWNER = 'bench'
+# The page size of a comparison's commits when per_page is not given, as on GitHub.
+COMPARE_PAGE_SIZE = 250
+
+
+def github_date(date):
+    return date.replace('+00:00', 'Z') if date.endswith('+00:00') else date
+
+
+class FakeGitHubHandler(FakeGitLabHandler):
+    """The REST endpoints the github site type reads and the GraphQL queries of github-graphql."""
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == '/_stats':
+            with server.stats_lock:
+                stats = dict(server.stats)
+            return self.respond(200, stats, count=False)
+        self.count_request()
+
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        repositories = server.repositories
+        if parts == ['user', 'repos']:
+            return self.respond_page(url, query, [self.repository(i) for i in range(1, repositories.projects + 1)])
+        if len(parts) >= 3 and parts[0] == 'repos':
+            project_id = self.project_id(parts[1], parts[2])
+            if project_id is None:
+                return self.respond(404, {'message': 'Not Found'})
+            if len(parts) == 3:
+                return self.respond(200, self.repository(project_id))
+            if parts[3] == 'branches':
+                branches = [self.branch(project_id, name) for name in repositories.branch_names()]
+                if len(parts) == 4:
+                    return self.respond_page(url, query, branches)
+                branch = next((branch for branch in branches if branch['name'] == parts[4]), None)
+                return self.respond(200, branch) if branch else self.respond(404, {'message': 'Branch not found'})
+            if parts[3] == 'commits' and len(parts) == 4:
+                self.count_commit_request()
+                commits = repositories.history(project_id, query.get('sha', 'master'), query.get('since'))
+                return self.respond_page(url, query, [self.commit(project_id, commit) for commit in commits])
+            if parts[3] == 'commits':
+                commit = repositories.commits_by_sha(project_id).get(parts[4])
+                if commit is None:
+                    return self.respond(404, {'message': 'No commit found'})
+                return self.respond(200, self.commit(project_id, commit, stats=True))
+            if parts[3] == 'compare':
+                self.count_commit_request()
+                base, head = parts[4].split('...', 1)
+                # Pushes compare up to the SHA of a branch tip, the branches only add commits on top of master.
+                tips = {repositories.history(project_id, name)[0]['id']: name for name in repositories.branch_names()}
+                commits = repositories.history(project_id, f"master..{tips.get(head, head)}")[::-1]
+                return self.respond_page(url, query, [self.commit(project_id, commit) for commit in commits],
+                                         key='commits', page_size=COMPARE_PAGE_SIZE)
+        return self.respond(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        self.count_request()
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if urlparse(self.path).path != '/graphql':
+            return self.respond(404, {'message': 'Not Found'})
+        variables = body['variables']
+        project_id = self.project_id(variables['owner'], variables['name'])
+        if project_id is None:
+            return self.respond(200, {'data': {'repository': None},
+                                      'errors': [{'message': f"Could not resolve to a Repository {variables['name']}"}]})
+        repositories = self.server.repositories
+        offset = int(variables.get('cursor') or 0)
+        if 'refs(' in body['query']:
+            names = repositories.branch_names()
+            page = names[offset:offset + 100]
+            refs = {'nodes': [{'name': name} for name in page], 'pageInfo': self.page_info(offset, len(page), len(names))}
+            return self.respond(200, {'data': {'repository': {'refs': refs}}})
+
+        self.count_commit_request()
+        branch = variables['ref'][len('refs/heads/'):]
+        if branch not in repositories.branch_names():
+            return self.respond(200, {'data': {'repository': {'ref': None}}})
+        commits = repositories.history(project_id, branch, variables.get('since'))
+        page = commits[offset:offset + 100]
+        history = {'nodes': [self.history_node(commit) for commit in page],
+                   'pageInfo': self.page_info(offset, len(page), len(commits))}
+        return self.respond(200, {'data': {'repository': {'ref': {'target': {'history': history}}}}})
+
+    def count_request(self):
+        with self.server.stats_lock:
+            self.server.stats['requests'] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def count_commit_request(self):
+        with self.server.stats_lock:
+            self.server.stats['commit_requests'] += 1
+
+    def project_id(self, owner, name):
+        prefix = 'project-'
+        if owner != OWNER or not name.startswith(prefix) or not name[len(prefix):].isdigit():
+            return None
+        project_id = int(name[len(prefix):])
+        return project_id if 1 <= project_id <= self.server.repositories.projects else None
+
+    def api_url(self, path):
+        return f"http://{self.headers['Host']}{path}"
+
+    def repository(self, project_id):
+        project = self.server.repositories.project(project_id)
+        full_name = project['path_with_namespace']
+        return {
+            'id': project_id,
+            'name': project['name'],
+            'full_name': full_name,
+            'owner': {'login': OWNER, 'type': 'Organization'},
+            'description': None,
+            'default_branch': project['default_branch'],
+            'pushed_at': github_date(project['last_activity_at']),
+            'html_url': project['web_url'],
+            'url': self.api_url(f"/repos/{full_name}")
+        }
+
+    def branch(self, project_id, name):
+        head = self.server.repositories.history(project_id, name)[0]['id']
+        return {'name': name, 'protected': False,
+                'commit': {'sha': head, 'url': self.api_url(f"/repos/{OWNER}/project-{project_id}/commits/{head}")}}
+
+    def commit(self, project_id, commit, stats=False):
+        """A commit of the list and compare endpoints, which leave out the stats of the single commit endpoint."""
+        commits_url = self.api_url(f"/repos/{OWNER}/project-{project_id}/commits")
+        author = {'name': commit['author_name'], 'email': commit['author_email'], 'date': github_date(commit['created_at'])}
+        body = {
+            'sha': commit['id'],
+            'url': f"{commits_url}/{commit['id']}",
+            'commit': {'author': author, 'committer': author, 'message': commit['message']},
+            'author': None,
+            'committer': None,
+            'parents': [{'sha': parent, 'url': f"{commits_url}/{parent}"} for parent in commit['parent_ids']]
+        }
+        if stats:
+            body['stats'] = commit['stats']
+        return body
+
+    def history_node(self, commit):
+        return {
+            'oid': commit['id'],
+            'message': commit['message'],
+            'additions': commit['stats']['additions'],
+            'deletions': commit['stats']['deletions'],
+            'author': {'name': commit['author_name'], 'date': github_date(commit['created_at'])},
+            'parents': {'nodes': [{'oid': parent} for parent in commit['parent_ids']]}
+        }
+
+    def page_info(self, offset, count, total):
+        return {'hasNextPage': offset + count < total, 'endCursor': str(offset + count)}
+
+    def respond_page(self, url, query, items, key=None, page_size=None):
+        """One page of items and a Link header to the next, the items under key for responses wrapping them."""
+        per_page = min(int(query.get('per_page', page_size or self.server.page_size)), 100 if key is None else 1000)
+        page = int(query.get('page', 1))
+        pages = max((len(items) + per_page - 1) // per_page, 1)
+        headers = {}
+        if page < pages:
+            next_url = self.api_url(f"{url.path}?{urlencode({**query, 'page': page + 1, 'per_page': per_page})}")
+            headers['Link'] = f'<{next_url}>; rel="next"'
+        page_items = items[(page - 1) * per_page:page * per_page]
+        self.respond(200, page_items if key is None else {key: page_items, 'total_commits': len(items)}, headers)
+
+
+class FakeGitHubServer(FakeGitLabServer):
+    handler_class = FakeGitHubHandler
+
+
+def main():
+    args = parse_arguments('Serve synthetic projects through a GitHub compatible REST and GraphQL API')
+    repositories = SyntheticRepositories(args.projects, args.commits, args.branches, args.branch_commits)
+    server = FakeGitHubServer(repositories, args.port, args.latency, args.page_size)
+    print(f"Serving {args.projects} projects on {server.url}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import argparse
+import functools
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlencode, urlparse
+
+API_PREFIX = '/api/v4'
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class SyntheticRepositories:
+    """Projects with a linear master history and branches that each add a few commits on top of it."""
+    def __init__(self, projects, commits, branches=0, branch_commits=10, authors=20):
+        self.projects = projects
+        self.commits = commits
+        self.branches = branches
+        self.branch_commits = branch_commits
+        self.authors = authors
+
+    def project(self, project_id):
+        return {
+            'id': project_id,
+            'name': f"project-{project_id}",
+            'path_with_namespace': f"bench/project-{project_id}",
+            'name_with_namespace': f"Bench / project-{project_id}",
+            'default_branch': 'master',
+            'last_activity_at': self.commit_date(self.commits).isoformat(),
+            'web_url': f"http://localhost/bench/project-{project_id}"
+        }
+
+    def branch_names(self):
+        return ['master'] + [f"feature-{b}" for b in range(self.branches)]
+
+    def commit_date(self, index):
+        return START + timedelta(minutes=37 * index)
+
+    def commit(self, project_id, branch, index):
+        sha = hashlib.sha1(f"{project_id}/{branch}/{index}".encode()).hexdigest()
+        if index == 0 and branch == 'master':
+            parents = []
+        elif index == 0:
+            parents = [hashlib.sha1(f"{project_id}/master/{self.commits - 1}".encode()).hexdigest()]
+        else:
+            parents = [hashlib.sha1(f"{project_id}/{branch}/{index - 1}".encode()).hexdigest()]
+        date = self.commit_date(index if branch == 'master' else self.commits + index).isoformat(timespec='milliseconds')
+        additions, deletions = (index * 7) % 300, (index * 3) % 120
+        return {
+            'id': sha,
+            'short_id': sha[:8],
+            'title': f"Change {index} on {branch}",
+            'message': f"Change {index} on {branch}\n\nSynthetic commit for benchmarking.",
+            'author_name': f"author-{(project_id + index) % self.authors}",
+            'author_email': f"author-{(project_id + index) % self.authors}@example.com",
+            'authored_date': date,
+            'created_at': date,
+            'committed_date': date,
+            'parent_ids': parents,
+            'stats': {'additions': additions, 'deletions': deletions, 'total': additions + deletions}
+        }
+
+    @functools.lru_cache(maxsize=256)
+    def history(self, project_id, ref, since=None):
+        """Newest first, like the commits API, with ref either a branch or a default..branch range.
+
+        Cached, as every page of a listing is cut from the same history.
+        """
+        if '..' in ref:
+            branch = ref.split('..', 1)[1]
+            commits = [self.commit(project_id, branch, i) for i in range(self.branch_commits)]
+        elif ref == 'master':
+            commits = [self.commit(project_id, 'master', i) for i in range(self.commits)]
+        else:
+            commits = [self.commit(project_id, 'master', i) for i in range(self.commits)] + \
+                      [self.commit(project_id, ref, i) for i in range(self.branch_commits)]
+        if since:
+            since = datetime.fromisoformat(since.replace('Z', '+00:00'))
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            commits = [c for c in commits if datetime.fromisoformat(c['created_at']) >= since]
+        return commits[::-1]
+
+    @functools.lru_cache(maxsize=64)
+    def commits_by_sha(self, project_id):
+        """Every commit of a project, master's and the branches', for lookups of a single commit."""
+        commits = {}
+        for branch in self.branch_names():
+            commits.update((commit['id'], commit) for commit in self.history(project_id, branch))
+        return commits
+
+
+class FakeGitLabHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would hold the body back for the delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == '/_stats':
+            with server.stats_lock:
+                stats = dict(server.stats)
+            return self.respond(200, stats, count=False)
+        with server.stats_lock:
+            server.stats['requests'] += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        parts = url.path[len(API_PREFIX):].strip('/').split('/') if url.path.startswith(API_PREFIX) else []
+        repositories = server.repositories
+        if parts == ['projects']:
+            return self.respond_page(url, query, [repositories.project(i) for i in range(1, repositories.projects + 1)])
+        if len(parts) >= 2 and parts[0] == 'projects' and parts[1].isdigit():
+            project_id = int(parts[1])
+            if not 1 <= project_id <= repositories.projects:
+                return self.respond(404, {'message': '404 Project Not Found'})
+            if len(parts) == 2:
+                return self.respond(200, repositories.project(project_id))
+            if parts[2:4] == ['repository', 'branches']:
+                branches = [{'name': name, 'default': name == 'master'} for name in repositories.branch_names()]
+                if len(parts) == 4:
+                    return self.respond_page(url, query, branches)
+                return self.respond(200, branches[0]) if parts[4] == 'master' else \
+                    self.respond(200, {'name': parts[4], 'default': False})
+            if parts[2:] == ['repository', 'commits']:
+                with server.stats_lock:
+                    server.stats['commit_requests'] += 1
+                commits = repositories.history(project_id, query.get('ref_name', 'master'), query.get('since'))
+                return self.respond_page(url, query, commits)
+        return self.respond(404, {'message': '404 Not Found'})
+
+    def respond_page(self, url, query, items):
+        per_page = min(int(query.get('per_page', self.server.page_size)), 100)
+        page = int(query.get('page', 1))
+        pages = max((len(items) + per_page - 1) // per_page, 1)
+        headers = {'X-Page': str(page), 'X-Per-Page': str(per_page), 'X-Total': str(len(items)),
+                   'X-Total-Pages': str(pages)}
+        if page < pages:
+            next_url = f"http://{self.headers['Host']}{url.path}?{urlencode({**query, 'page': page + 1, 'per_page': per_page})}"
+            headers['X-Next-Page'] = str(page + 1)
+            headers['Link'] = f'<{next_url}>; rel="next"'
+        self.respond(200, items[(page - 1) * per_page:page * per_page], headers)
+
+    def respond(self, status, body, headers=None, count=True):
+        payload = json.dumps(body).encode()
+        if count:
+            with self.server.stats_lock:
+                self.server.stats['bytes'] += len(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeGitLabServer(ThreadingHTTPServer):
+    daemon_threads = True
+    handler_class = FakeGitLabHandler
+
+    def __init__(self, repositories, port=0, latency=0.0, page_size=20):
+        super().__init__(('127.0.0.1', port), self.handler_class)
+        self.repositories = repositories
+        self.latency = latency
+        self.page_size = page_size
+        self.stats = {'requests': 0, 'commit_requests': 0, 'bytes': 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+def parse_arguments(description='Serve synthetic projects through a GitLab compatible REST API'):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--port', required=False, type=int, help='Port to listen on', default=8929)
+    parser.add_argument('--projects', required=False, type=int, help='Number of projects', default=10)
+    parser.add_argument('--commits', required=False, type=int, help='Commits on master per project', default=1000)
+    parser.add_argument('--branches', required=False, type=int, help='Branches besides master per project', default=0)
+    parser.add_argument('--branch-commits', required=False, type=int, help='Commits each branch adds', default=10)
+    parser.add_argument('--latency', required=False, type=float, help='Seconds added to each request', default=0.0)
+    parser.add_argument('--page-size', required=False, type=int, help='Items per page when per_page is not given', default=20)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    repositories = SyntheticRepositories(args.projects, args.commits, args.branches, args.branch_commits)
+    server = FakeGitLabServer(repositories, args.port, args.latency, args.page_size)
+    print(f"Serving {args.projects} projects on {server.url}{API_PREFIX}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from metrics_store_influx import InfluxDBMetricsStore
+from metrics_store_ts import TimestreamMetricsStore, WRITE_BATCH_SIZE
+
+COMMIT_MEASURES = ('id', 'commit')
+
+
+class SinkStats:
+    """Totals of the writes received by every in-memory store of a run."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.records = 0
+        self.commits = 0
+        self.bytes = 0
+
+    def add(self, records, commits, size=0):
+        with self.lock:
+            self.requests += 1
+            self.records += records
+            self.commits += commits
+            self.bytes += size
+
+    def as_dict(self):
+        return {'write_requests': self.requests, 'records': self.records, 'commits': self.commits, 'bytes': self.bytes}
+
+
+class FakeTimestreamWriteClient:
+    """Accepts WriteRecords calls like the timestream-write client, without sending them anywhere."""
+    def __init__(self, exceptions, stats, latency=0.0):
+        self.exceptions = exceptions
+        self.stats = stats
+        self.latency = latency
+
+    def write_records(self, DatabaseName, TableName, Records, CommonAttributes=None):
+        if len(Records) > WRITE_BATCH_SIZE:
+            raise ValueError(f"{len(Records)} records in one WriteRecords request")
+        if self.latency:
+            time.sleep(self.latency)
+        commits = sum(1 for record in Records if record.get('MeasureName') in COMMIT_MEASURES)
+        self.stats.add(len(Records), commits)
+        return {'RecordsIngested': {'Total': len(Records)}}
+
+    def close(self):
+        pass
+
+
+class FakeTimestreamQueryClient:
+    def query(self, **kwargs):
+        return {'Rows': []}
+
+    def close(self):
+        pass
+
+
+class MemoryTimestreamStore(TimestreamMetricsStore):
+    def __init__(self, stats, latency=0.0, write_concurrency=4):
+        super().__init__('us-east-1', 'benchmark', 'benchmark', write_concurrency)
+        # The real clients are only kept for their exception classes.
+        exceptions = self.write_client.exceptions
+        self.write_client.close()
+        self.query_client.close()
+        self.write_client = FakeTimestreamWriteClient(exceptions, stats, latency)
+        self.query_client = FakeTimestreamQueryClient()
+
+    def create_table(self, database, table, s3_bucket=None):
+        pass
+
+
+class FakeInfluxDBWriteApi:
+    def __init__(self, stats, latency=0.0):
+        self.stats = stats
+        self.latency = latency
+
+    def write(self, bucket, record, write_precision=None):
+        if self.latency:
+            time.sleep(self.latency)
+        commits = sum(1 for line in record if line.split(',', 1)[0] in COMMIT_MEASURES)
+        self.stats.add(len(record), commits, sum(len(line) + 1 for line in record))
+
+
+class FakeInfluxDBQueryApi:
+    def query(self, query_string):
+        return []
+
+
+class MemoryInfluxDBStore(InfluxDBMetricsStore):
+    def __init__(self, stats, latency=0.0, write_mode='sync', batch_size=5000, flush_interval=1.0, max_inflight=4):
+        super().__init__('http://127.0.0.1:8086', 'benchmark', 'benchmark', write_mode, batch_size, flush_interval,
+                         max_inflight)
+        self.write_api = FakeInfluxDBWriteApi(stats, latency)
+        self.query_api = FakeInfluxDBQueryApi()
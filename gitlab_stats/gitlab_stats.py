@@ -1,17 +1,48 @@
 import argparse
+import pickle
+import queue
+import signal
+import tempfile
+import threading
+import time
 
 from concurrent import futures
 from datetime import datetime
+from requests.adapters import DEFAULT_POOLSIZE
+from http_cache import CachingAdapter, ResponseCache
+from ingestion_scheduler import IngestionJob, IngestionScheduler
+from ingestion_state import IngestionState
+from instrumentation import METRICS, Profiler, serve_metrics
+from rate_limiter import RateLimitedAdapter, RateLimiter
+from team_index import TeamIndex
+from sha_index import ShaSet
+from time_util import as_utc
 from metrics_fetcher_github import GitHubMetricsFetcher
+from metrics_fetcher_github_graphql import GitHubGraphQLMetricsFetcher
+from metrics_fetcher_git import GitMirrorMetricsFetcher
 from metrics_fetcher_gitlab import GitLabMetricsFetcher
+from metrics_rollup import DailyRollups
+from metrics_store import PreloadedWatermarks
 from metrics_store_ts import TimestreamMetricsStore, TimestreamMetricsProcessor
 from metrics_store_influx import InfluxDBMetricsStore, InfluxDBMetricsProcessor
+from metrics_store_parquet import ParquetMetricsStore, ParquetMetricsProcessor
+from webhook_server import WebhookServer
 
+WRITE_BATCH_SIZE = 100
+PROCESSOR_TYPES = {'timestream': TimestreamMetricsProcessor, 'influxdb': InfluxDBMetricsProcessor,
+                   'parquet': ParquetMetricsProcessor}
+# Commits submitted to the store before the writer waits for them to be written and records them.
+CONFIRM_COMMITS = 20000
+# Least seconds between the project listings pushes to unknown projects trigger, the polls list them anyway.
+UNKNOWN_REFRESH_SECONDS = 60
+INITIAL_SINCE = datetime.strptime('2000-01-01T00:00:00.000Z', '%Y-%m-%dT%H:%M:%S.%fZ')
 
-def parse_arguments():
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(description='GitLab to Timestream')
     parser.add_argument('-k', '--access-key', required=True, help='GitLab Access Token')
     parser.add_argument('-u', '--gitlab-url', required=False, help='GitLab URL')
+    parser.add_argument('--github-url', required=False, help='GitHub API URL for the github site types, e.g. https://github.example.com/api/v3, api.github.com by default')
     parser.add_argument('-r', '--region', required=False, help='AWS Region', default="us-east-1")
     parser.add_argument('-d', '--database', required=False, help='Timestream Database')
     parser.add_argument('-c', '--s3-bucket', required=True, help='S3 Bucket for Magnetic Store Writes')
@@ -21,77 +52,575 @@ def parse_arguments():
     parser.add_argument('-b', '--all-branch', required=False, help='Capture all branches', default=False)
     parser.add_argument('-l', '--reload', required=False, help='Timestream Table', default=False)
     parser.add_argument('-p', '--project', required=False, help='A specific Project to parse')
-    parser.add_argument('--store-type', required=False, choices=['timestream', 'influxdb'], help='Type of metrics store', default = "timestream")
+    parser.add_argument('--store-type', required=False, choices=['timestream', 'influxdb', 'parquet'], help='Type of metrics store', default = "timestream")
+    parser.add_argument('--parquet-dir', required=False, help='Directory of the Parquet files written by the parquet store', default='parquet')
     parser.add_argument('--influxdb-url', required=False, help='InfluxDB URL')
     parser.add_argument('--influxdb-token', required=False, help='InfluxDB Token')
     parser.add_argument('--influxdb-org', required=False, help='InfluxDB Organization')
-    parser.add_argument('--site-type', required=False, choices=['gitlab', 'github'], help='Type of site to fetch metrics from', default='gitlab')
+    parser.add_argument('--influxdb-write-mode', required=False, choices=['sync', 'batching'], help='Write each batch before returning, or buffer and write in the background', default='sync')
+    parser.add_argument('--influxdb-batch-size', required=False, type=int, help='Points per InfluxDB write', default=5000)
+    parser.add_argument('--influxdb-flush-interval', required=False, type=float, help='Seconds before a partial batch is written in batching mode', default=1.0)
+    parser.add_argument('--influxdb-max-inflight', required=False, type=int, help='Concurrent InfluxDB writes in batching mode', default=4)
+    parser.add_argument('--influxdb-gzip', required=False, action='store_true', help='Gzip InfluxDB requests')
+    parser.add_argument('--site-type', required=False, choices=['gitlab', 'github', 'github-graphql', 'git-mirror'], help='Type of site to fetch metrics from', default='gitlab')
+    parser.add_argument('--http-cache-dir', required=False, help='Directory of the conditional request cache for GitLab/GitHub API responses')
+    parser.add_argument('--http-cache-size-mb', required=False, type=int, help='Size bound of the HTTP response cache', default=512)
+    parser.add_argument('--api-initial-rate', required=False, type=float, help='API requests per second until the server reports its rate limit', default=10.0)
+    parser.add_argument('--api-burst', required=False, type=int, help='API requests that may be sent at once above the paced rate', default=20)
+    parser.add_argument('--api-reserve', required=False, type=float, help='Share of the API rate limit left unused', default=0.05)
+    parser.add_argument('--git-mirror-dir', required=False, help='Directory of bare repositories for the git-mirror site type')
+    parser.add_argument('--git-remote', required=False, action='append', help='Repository to clone into the mirror directory when missing, can be repeated')
+    parser.add_argument('--git-mirror-update', required=False, action='store_true', help='Fetch mirrored repositories before reading them')
+    parser.add_argument('-w', '--workers', required=False, type=int, help='Number of projects fetched concurrently', default=1)
+    parser.add_argument('--ts-write-concurrency', required=False, type=int, help='Concurrent Timestream WriteRecords calls', default=4)
+    parser.add_argument('--ts-max-retries', required=False, type=int, help='Retries of a throttled Timestream write', default=5)
+    parser.add_argument('--dead-letter-file', required=False, help='JSON lines file receiving records the store rejected')
+    parser.add_argument('--multi-measure', required=False, action='store_true', help='Write one multi-measure record per commit')
+    parser.add_argument('--migrate-multi-measure', required=False, action='store_true', help='Rewrite existing single-measure records as multi-measure records and exit')
+    parser.add_argument('--state-dir', required=False, help='Directory of the local ingestion state, avoids reading watermarks back from the store')
+    parser.add_argument('--rebuild-state', required=False, action='store_true', help='Rebuild the local ingestion state from the store')
+    parser.add_argument('--preload-commit-ids', required=False, action='store_true', help='Load the commit ids of all projects in one query, along with their watermarks')
+    parser.add_argument('--skip-unchanged', required=False, action='store_true', help='Skip projects with no activity since they were last ingested')
+    parser.add_argument('--daily-rollups', required=False, action='store_true', help='Upsert per day, project and author commit totals, which the Git Commit by Day dashboards read; add --reload true once to build them from the whole history')
+    parser.add_argument('--rollup-table', required=False, help='Timestream Table of the daily rollups', default="gitlab-history-daily")
+    parser.add_argument('--team-file', required=False, action='append', help='Team changes or snapshot file of member_team.py with an author field per item, commits get the team of their author as a dimension, can be repeated')
+    parser.add_argument('--retag-teams', required=False, action='store_true', help='Copy the commits of the table into --retag-table with the team of their author from --team-file and exit')
+    parser.add_argument('--retag-table', required=False, help='Timestream Table, or InfluxDB bucket, receiving the re-tagged commits')
+    parser.add_argument('--write-queue-size', required=False, type=int, help='Max record batches waiting to be written', default=64)
+    parser.add_argument('--metrics-file', required=False, help='Prometheus text file the run metrics are written to, e.g. for the node exporter textfile collector')
+    parser.add_argument('--metrics-port', required=False, type=int, help='Port serving the run metrics on /metrics while ingesting')
+    parser.add_argument('--self-metrics', required=False, action='store_true', help='Write the run metrics into the metrics store')
+    parser.add_argument('--self-metrics-table', required=False, help='Timestream Table of the run metrics', default="gitlab-stats-ingestion")
+    parser.add_argument('--daemon', required=False, action='store_true', help='Keep running, ingesting pushed commits from webhooks and polling for projects with new activity')
+    parser.add_argument('--webhook-port', required=False, type=int, help='Port receiving GitLab and GitHub push webhooks in daemon mode', default=8080)
+    parser.add_argument('--webhook-secret', required=False, help='GitLab webhook token or GitHub webhook secret')
+    parser.add_argument('--poll-interval', required=False, type=float, help='Seconds between polls for projects with new activity in daemon mode, 0 to only poll at startup', default=3600)
+    parser.add_argument('--profile', required=False, help='File receiving cProfile stats of all ingestion threads, readable with pstats or snakeviz')
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 class Context:
+    """Builds fetcher and store clients per thread, as none of them are safe to share between threads."""
     def __init__(self, args):
         self.args = args
-        if args.site_type == 'gitlab':
-            self.metrics_fetcher = GitLabMetricsFetcher(args.gitlab_url, args.access_key)
-        elif args.site_type == 'github':
-            self.metrics_fetcher = GitHubMetricsFetcher(args.access_key)
-        else:
+        if args.site_type not in ('gitlab', 'github', 'github-graphql', 'git-mirror'):
             raise ValueError("Unsupported site type")
-
-        if args.store_type == 'timestream':
-            self.metrics_store = TimestreamMetricsStore(args.region, args.aws_access_key, args.aws_access_secret)
-            self.metrics_processor = TimestreamMetricsProcessor(self.metrics_store)
-        elif args.store_type == 'influxdb':
-            self.metrics_store = InfluxDBMetricsStore(args.influxdb_url, args.influxdb_token, args.influxdb_org)
-            self.metrics_processor = InfluxDBMetricsProcessor(self.metrics_store)
-        else:
+        if args.store_type not in ('timestream', 'influxdb', 'parquet'):
             raise ValueError("Unsupported store type")
+        if args.daily_rollups and not PROCESSOR_TYPES[args.store_type].supports_daily_rollups:
+            raise ValueError(f"Daily rollups are not supported by the {args.store_type} store")
+        if args.retag_teams and not (args.team_file and args.retag_table):
+            raise ValueError("Re-tagging teams requires --team-file and --retag-table")
+        self.local = threading.local()
+        self.stores = []
+        self.stores_lock = threading.Lock()
+        self.preloaded = PreloadedWatermarks()
+        self.team_index = TeamIndex.load(args.team_file) if args.team_file else None
+        self.state = IngestionState(args.state_dir) if args.state_dir else None
+        self.http_cache = ResponseCache(args.http_cache_dir, args.http_cache_size_mb * 1024 * 1024) \
+            if args.http_cache_dir else None
+        # Shared by the fetchers of every thread, adapters are thread-safe and so are the cache and the limiter.
+        self.rate_limiter = RateLimiter(args.api_initial_rate, args.api_burst, args.api_reserve)
+        # One pooled connection per worker, urllib3 would otherwise drop and reopen the ones above its default of 10.
+        pool_maxsize = max(DEFAULT_POOLSIZE, args.workers)
+        if self.http_cache is not None:
+            self.http_adapter = CachingAdapter(self.http_cache, self.rate_limiter, pool_maxsize=pool_maxsize)
+        else:
+            self.http_adapter = RateLimitedAdapter(self.rate_limiter, pool_maxsize=pool_maxsize)
+
+        self.profiler = Profiler() if args.profile else None
+        self.metrics_server = serve_metrics(args.metrics_port) if args.metrics_port else None
 
         self.metrics_store.create_table(args.database, args.table, args.s3_bucket)
+        if args.daily_rollups:
+            self.metrics_store.create_table(args.database, args.rollup_table, args.s3_bucket)
+        if args.self_metrics:
+            self.metrics_store.create_table(args.database, args.self_metrics_table, args.s3_bucket)
+        if args.retag_teams:
+            self.metrics_store.create_table(args.database, args.retag_table, args.s3_bucket)
+
+    @property
+    def metrics_fetcher(self):
+        if not hasattr(self.local, 'metrics_fetcher'):
+            if self.args.site_type == 'gitlab':
+                self.local.metrics_fetcher = GitLabMetricsFetcher(self.args.gitlab_url, self.args.access_key,
+                                                                   self.http_adapter)
+            elif self.args.site_type == 'github':
+                self.local.metrics_fetcher = GitHubMetricsFetcher(self.args.access_key, self.http_adapter,
+                                                                   self.args.github_url)
+            elif self.args.site_type == 'github-graphql':
+                self.local.metrics_fetcher = GitHubGraphQLMetricsFetcher(self.args.access_key, self.http_adapter,
+                                                                          self.args.github_url)
+            else:
+                self.local.metrics_fetcher = GitMirrorMetricsFetcher(self.args.git_mirror_dir, self.args.git_remote,
+                                                                     self.args.git_mirror_update)
+        return self.local.metrics_fetcher
+
+    def thread_store(self):
+        if not hasattr(self.local, 'metrics_store'):
+            self.local.metrics_store, self.local.metrics_processor = self.build_store()
+            with self.stores_lock:
+                self.stores.append(self.local.metrics_store)
+        return self.local
+
+    def build_store(self):
+        """Returns a new store and its processor, called once per thread."""
+        if self.args.store_type == 'timestream':
+            store = TimestreamMetricsStore(self.args.region, self.args.aws_access_key, self.args.aws_access_secret,
+                                           self.args.ts_write_concurrency, self.args.ts_max_retries,
+                                           self.args.dead_letter_file)
+            return store, TimestreamMetricsProcessor(store, self.args.multi_measure, self.preloaded, self.team_index)
+        if self.args.store_type == 'parquet':
+            store = ParquetMetricsStore(self.args.parquet_dir)
+            return store, ParquetMetricsProcessor(store, self.args.multi_measure, self.preloaded, self.team_index)
+        store = InfluxDBMetricsStore(self.args.influxdb_url, self.args.influxdb_token, self.args.influxdb_org,
+                                     self.args.influxdb_write_mode, self.args.influxdb_batch_size,
+                                     self.args.influxdb_flush_interval, self.args.influxdb_max_inflight,
+                                     self.args.influxdb_gzip)
+        return store, InfluxDBMetricsProcessor(store, self.args.multi_measure, self.preloaded, self.team_index)
+
+    @property
+    def metrics_store(self):
+        return self.thread_store().metrics_store
+
+    @property
+    def metrics_processor(self):
+        return self.thread_store().metrics_processor
+
+    def close(self):
+        with self.stores_lock:
+            for store in self.stores:
+                store.close()
+            self.stores.clear()
+        if self.state is not None:
+            self.state.close()
+        self.http_adapter.close()
+        if self.http_cache is not None:
+            self.http_cache.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+
+    def __enter__(self):
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-       self.metrics_store.close()
+        self.close()
+
+
+class IngestionSummary:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.projects = 0
+        self.skipped = 0
+        self.records = {}
+        self.failures = {}
 
+    def project_done(self):
+        with self.lock:
+            self.projects += 1
 
-def generate_project_records(context, project, default_branch):
-    processed_commits = context.metrics_processor.load_latest_commit(context.args, project.name)
-    if not context.args.reload and project.name in processed_commits:
-        since = processed_commits.get(project.name, 0)
+    def project_skipped(self):
+        with self.lock:
+            self.skipped += 1
+
+    def records_written(self, project_name, count):
+        with self.lock:
+            self.records[project_name] = self.records.get(project_name, 0) + count
+
+    def project_failed(self, project_name, error):
+        with self.lock:
+            self.failures.setdefault(project_name, str(error))
+
+    def has_failed(self, project_name):
+        with self.lock:
+            return project_name in self.failures
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        print(f"Processed {self.projects} projects ({self.skipped} unchanged), wrote {sum(self.records.values())} records "
+              f"in {elapsed:.1f}s, {len(self.failures)} projects failed.")
+        for project_name, error in sorted(self.failures.items()):
+            print(f"\tFailed project {project_name}: {error}")
+
+
+def load_watermark(context, project):
+    state = context.state
+    if state is not None and not context.args.rebuild_state and state.has_project(project.name):
+        return state.latest_commit(project.name), state.commit_ids(project.name)
+
+    with METRICS.timer('store_query'):
+        processed_commits = context.metrics_processor.load_latest_commit(context.args, project.name)
+        existing_commits = context.metrics_processor.get_all_commits_id(context.args, project.name)
+    latest = processed_commits.get(project.name)
+    if state is not None:
+        state.rebuild(project.name, latest, existing_commits)
+    return latest, existing_commits
+
+
+def generate_project_commits(context, project, default_branch):
+    latest, existing_commits = load_watermark(context, project)
+    if not context.args.reload and latest is not None:
+        since = latest
     else:
-        since = datetime.strptime('2000-01-01T00:00:00.000Z', '%Y-%m-%dT%H:%M:%S.%fZ')
-    commits = context.metrics_fetcher.fetch_commits(project, since, context.args.all_branch)
-    existing_commits = context.metrics_processor.get_all_commits_id(context.args, project.name)
-    print(f"Retrieved {len(commits)} commits in project: {project.name} since ${since}")
+        since = INITIAL_SINCE
+    known_commits = ShaSet() if context.args.reload else existing_commits
+    commits = context.metrics_fetcher.fetch_commits(project, since, context.args.all_branch, known_commits)
 
-    for commit in commits:
+    count = 0
+    for commit in METRICS.timed_iter('fetch_commits', commits):
+        count += 1
         if context.args.reload or commit.sha not in existing_commits:
             existing_commits.add(commit.sha)
-            yield from context.metrics_processor.process_commit(commit, project)
+            yield commit
+    print(f"Retrieved {count} commits in project: {project.name} since ${since}")
+    METRICS.count('commits_fetched', count)
 
 
-def main():
-    args = parse_arguments()
-    context = Context(args)
-    context.metrics_store.create_table(args.database, args.table, args.s3_bucket)
+def generate_pushed_commits(context, project, ranges):
+    latest, existing_commits = load_watermark(context, project)
+    since = latest if latest is not None else INITIAL_SINCE
+    count = 0
+    for branch, (before, after) in ranges.items():
+        if not context.args.all_branch and branch != 'master':
+            continue
+        commits = context.metrics_fetcher.fetch_commit_range(project, branch, before, after, since, existing_commits)
+        for commit in METRICS.timed_iter('fetch_commits', commits):
+            count += 1
+            if commit.sha not in existing_commits:
+                existing_commits.add(commit.sha)
+                yield commit
+    print(f"Retrieved {count} pushed commits in project: {project.name}")
+    METRICS.count('commits_fetched', count)
+
+
+def is_unchanged(context, project, activity):
+    if activity is None or context.args.reload:
+        return False
+    state = context.state
+    if state is not None and not context.args.rebuild_state and state.has_project(project.name):
+        ingested_activity = state.activity(project.name)
+    else:
+        with METRICS.timer('store_query'):
+            ingested_activity = context.metrics_processor.load_latest_commit(context.args, project.name).get(project.name)
+    return ingested_activity is not None and activity <= as_utc(ingested_activity)
+
 
-    projects = [p for p in context.metrics_fetcher.fetch_projects()
-                if args.project is None or p.name == args.project]
-    print(f"Loaded {len(projects)} projects from gitlab")
+def fetch_project(context, project, write_queue, summary, job=None):
+    """Queues the new commits of a project for writing, only the pushed ranges of a job without full set."""
+    with METRICS.project(project.name):
+        try:
+            if job is None or job.full:
+                # Polls in daemon mode would otherwise go through every project each time.
+                check_activity = context.args.skip_unchanged or context.args.daemon
+                activity = context.metrics_fetcher.project_activity(project) if check_activity else None
+                if is_unchanged(context, project, activity):
+                    summary.project_skipped()
+                    return
+                new_commits = generate_project_commits(context, project, "master")
+            else:
+                activity = None
+                new_commits = generate_pushed_commits(context, project, job.ranges)
 
-    def process_project(project):
-        records = [r for r in generate_project_records(context, project, "master")]
-        print(f"Processing {len(records)} new records in project: {project.name}")
-        context.metrics_store.write_records(records, args.database, args.table)
+            # The store's newest commit is its watermark, without a local state the batches of a project are
+            # spooled to disk until it is fetched completely, so a failed fetch can't move the watermark past
+            # commits that were never fetched.
+            spool = tempfile.TemporaryFile() if context.state is None else None
+            try:
+                records, commits = [], []
+                process_seconds, queue_seconds = 0.0, 0.0
+                for commit in new_commits:
+                    started = time.perf_counter()
+                    records.extend(context.metrics_processor.process_commit(commit, project))
+                    process_seconds += time.perf_counter() - started
+                    commits.append(commit)
+                    if len(records) >= WRITE_BATCH_SIZE:
+                        started = time.perf_counter()
+                        if spool is not None:
+                            pickle.dump((records, commits), spool)
+                        else:
+                            write_queue.put((project, records, commits, None, False))
+                        queue_seconds += time.perf_counter() - started
+                        records, commits = [], []
+                if spool is not None:
+                    started = time.perf_counter()
+                    for spooled_records, spooled_commits in read_spool(spool):
+                        write_queue.put((project, spooled_records, spooled_commits, None, False))
+                    queue_seconds += time.perf_counter() - started
+                # The last batch of a project carries its activity time, recorded once everything before it is written.
+                write_queue.put((project, records, commits, activity, True))
+            finally:
+                if spool is not None:
+                    spool.close()
+            METRICS.observe('process_commit', process_seconds)
+            # Time blocked on a full queue, fetching waits for the writer.
+            METRICS.observe('write_queue_wait', queue_seconds)
+        except Exception as e:
+            print(f"Failed to process project {project.name}: {str(e)}")
+            summary.project_failed(project.name, e)
+            METRICS.count('failed_projects')
+            # Closes the project in the writer, without moving its watermark.
+            write_queue.put((project, [], [], None, True))
+        finally:
+            summary.project_done()
 
-    # MultiThreading
-    # futures.ThreadPoolExecutor().map(process_project, projects)
 
-    # Single Thread
-    # Process projects
-    for project in projects:
-        process_project(project)
+def read_spool(spool):
+    spool.seek(0)
+    while True:
+        try:
+            yield pickle.load(spool)
+        except EOFError:
+            return
+
+
+def write_batches(context, write_queue, summary):
+    rollups = DailyRollups() if context.args.daily_rollups else None
+    # Newest commit written per project, the watermark moves to it once the whole project is written.
+    newest = {}
+    # Batches submitted to the store, recorded in the state once a flush has confirmed they are written.
+    pending, pending_commits = [], 0
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        project, records, commits, activity, last = item
+        submitted = True
+        with METRICS.project(project.name):
+            try:
+                if records:
+                    print(f"Processing {len(records)} new records in project: {project.name}")
+                    with METRICS.timer('write_records'):
+                        context.metrics_store.submit_records(records, context.args.database, context.args.table)
+                    summary.records_written(project.name, len(records))
+                    METRICS.count('records_written', len(records))
+            except Exception as e:
+                print(f"Failed to write records of project {project.name}: {str(e)}")
+                summary.project_failed(project.name, e)
+                submitted = False
+        pending.append((project, commits if submitted else [], activity, last))
+        pending_commits += len(commits)
+        # Stores keep writing while the next batches come in, until a project ends or too many commits wait.
+        if last or pending_commits >= CONFIRM_COMMITS:
+            confirm_batches(context, pending, newest, rollups, summary)
+            pending, pending_commits = [], 0
+    confirm_batches(context, pending, newest, rollups, summary)
+    # Projects that failed while being fetched still have the buckets of the batches written before.
+    if rollups is not None:
+        for project_name in rollups.project_names():
+            write_rollups(context, rollups, project_name, summary)
+
+
+def confirm_batches(context, pending, newest, rollups, summary):
+    """Flushes the store, then records the written batches and writes the rollups of the projects they end."""
+    failed = set()
+    try:
+        with METRICS.timer('flush'):
+            context.metrics_store.flush()
+    except Exception as e:
+        # Which of the in-flight records made it is unknown, none of them count as written.
+        print(f"Failed to write records: {str(e)}")
+        failed = {project.name for project, _, _, _ in pending}
+        for project_name in failed:
+            summary.project_failed(project_name, e)
+    for project, commits, activity, last in pending:
+        with METRICS.project(project.name):
+            try:
+                if project.name in failed:
+                    commits = []
+                if rollups is not None:
+                    rollups.add(project, commits)
+                    if last:
+                        write_rollups(context, rollups, project.name, summary)
+                if context.state is not None:
+                    with METRICS.timer('state'):
+                        record_state(context, project, commits, activity, last, newest, summary)
+            except Exception as e:
+                print(f"Failed to record written commits of project {project.name}: {str(e)}")
+                summary.project_failed(project.name, e)
+                newest.pop(project.name, None)
+
+
+def record_state(context, project, commits, activity, last, newest, summary):
+    context.state.record_commits(project.name, commits)
+    if commits:
+        latest = max(commit.date for commit in commits)
+        if project.name not in newest or as_utc(latest) > as_utc(newest[project.name]):
+            newest[project.name] = latest
+    if not last:
+        return
+    latest = newest.pop(project.name, None)
+    # A project that failed while being fetched keeps its previous watermark, the next run fetches the rest
+    # since there and skips the commits recorded here.
+    if summary.has_failed(project.name):
+        return
+    if latest is not None:
+        context.state.advance_latest(project.name, latest)
+    if activity is not None:
+        context.state.record_activity(project.name, activity)
+
+
+def write_rollups(context, rollups, project_name, summary):
+    try:
+        with METRICS.timer('daily_rollups', project_name):
+            context.metrics_processor.write_daily_rollups(context.args, project_name, rollups.pop(project_name))
+    except Exception as e:
+        print(f"Failed to write daily rollups of project {project_name}: {str(e)}")
+        summary.project_failed(project_name, e)
+
+
+def run(args, context):
+    if args.migrate_multi_measure:
+        context.metrics_processor.migrate_to_multi_measure(args)
+        return None
+    if args.retag_teams:
+        context.metrics_processor.retag_teams(args)
+        return None
+
+    with METRICS.timer('fetch_projects'):
+        projects = [p for p in context.metrics_fetcher.fetch_projects()
+                    if args.project is None or p.name == args.project]
+    print(f"Loaded {len(projects)} projects from {args.site_type}")
+    if args.project is None and (context.state is None or args.rebuild_state):
+        # One store query for all projects, rather than one or two per project.
+        with METRICS.timer('preload'):
+            context.metrics_processor.preload(args, args.preload_commit_ids)
+
+    summary = IngestionSummary()
+    # Bounded, so fetch workers block instead of buffering records faster than they can be written.
+    write_queue = queue.Queue(maxsize=args.write_queue_size)
+    profiled = context.profiler.wrap if context.profiler is not None else (lambda function: function)
+    writer = threading.Thread(target=profiled(write_batches), args=(context, write_queue, summary),
+                              name='metrics-writer')
+    writer.start()
+    try:
+        with futures.ThreadPoolExecutor(max_workers=max(args.workers, 1), thread_name_prefix='fetcher') as executor:
+            for project in projects:
+                executor.submit(profiled(fetch_project), context, project, write_queue, summary)
+    finally:
+        write_queue.put(None)
+        writer.join()
+    summary.report()
+    report_metrics(args, context)
+    return summary
+
+
+def report_metrics(args, context):
+    print(METRICS.stage_report())
+    if args.metrics_file:
+        METRICS.write_prometheus_file(args.metrics_file)
+    if args.self_metrics:
+        try:
+            context.metrics_store.write_records(METRICS.records(), args.database, args.self_metrics_table)
+        except Exception as e:
+            print(f"Failed to write ingestion metrics: {str(e)}")
+
+
+def run_daemon(args, context):
+    """Ingests pushed commit ranges as webhooks arrive, and projects with new activity at every poll.
+
+    Worker threads stay up between jobs, so their fetcher and store clients keep their connections.
+    """
+    scheduler = IngestionScheduler()
+    summary = IngestionSummary()
+    projects, projects_by_name, projects_lock = {}, {}, threading.Lock()
+    refresh_lock, refreshed = threading.Lock(), [float('-inf')]
+    stopped = threading.Event()
+
+    def refresh_projects():
+        refreshed[0] = time.monotonic()
+        with METRICS.timer('fetch_projects'):
+            listed = [p for p in context.metrics_fetcher.fetch_projects()
+                      if args.project is None or p.name == args.project]
+        with projects_lock:
+            projects.clear()
+            projects.update((str(p.id), p) for p in listed)
+            projects_by_name.clear()
+            projects_by_name.update((p.name, p) for p in listed)
+        return listed
+
+    def find_project(project_id, project_name):
+        with projects_lock:
+            return projects.get(project_id) or projects_by_name.get(project_name)
+
+    def find_new_project(project_id, project_name):
+        """Lists the projects again for a push to a project created since the last poll, at most once per
+        UNKNOWN_REFRESH_SECONDS, so pushes to projects that stay unknown don't list them all every time."""
+        with refresh_lock:
+            # Another worker may have listed the projects while this one waited.
+            project = find_project(project_id, project_name)
+            if project is None and time.monotonic() - refreshed[0] >= UNKNOWN_REFRESH_SECONDS:
+                refresh_projects()
+                project = find_project(project_id, project_name)
+            return project
+
+    def on_push(push):
+        print(f"Received a push of {push.commit_count} commits to {push.project_name}:{push.branch}")
+        METRICS.count('push_events')
+        scheduler.push(push.job())
+
+    def work():
+        while True:
+            job = scheduler.pop()
+            if job is None:
+                return
+            try:
+                project = find_project(job.project_id, job.project_name)
+                if project is None:
+                    project = find_new_project(job.project_id, job.project_name)
+                if project is None:
+                    print(f"Ignored a push to unknown project {job.project_name or job.project_id}")
+                else:
+                    fetch_project(context, project, write_queue, summary, job)
+            except Exception as e:
+                print(f"Failed to ingest project {job.project_id}: {str(e)}")
+            finally:
+                scheduler.done(job)
+
+    write_queue = queue.Queue(maxsize=args.write_queue_size)
+    writer = threading.Thread(target=write_batches, args=(context, write_queue, summary), name='metrics-writer')
+    writer.start()
+    workers = [threading.Thread(target=work, name=f"fetcher_{i}") for i in range(max(args.workers, 1))]
+    for worker in workers:
+        worker.start()
+    if not args.webhook_secret:
+        print("No --webhook-secret given, webhooks are accepted without authentication.")
+    server = WebhookServer(args.webhook_port, args.webhook_secret, on_push).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    try:
+        while True:
+            for project in refresh_projects():
+                scheduler.push(IngestionJob(str(project.id), project.name, full=True))
+            print(f"Queued {len(projects)} projects to poll, {len(scheduler)} jobs waiting.")
+            if stopped.wait(args.poll_interval if args.poll_interval > 0 else None):
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Stopping, waiting for the jobs in progress.")
+        server.shutdown()
+        server.server_close()
+        scheduler.close()
+        for worker in workers:
+            worker.join()
+        write_queue.put(None)
+        writer.join()
+        summary.report()
+        report_metrics(args, context)
+
+
+def main():
+    args = parse_arguments()
+    with Context(args) as context:
+        if args.daemon:
+            run_daemon(args, context)
+        elif context.profiler is None:
+            run(args, context)
+        else:
+            context.profiler.wrap(run)(args, context)
+            context.profiler.dump(args.profile)
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from instrumentation import METRICS
+from rate_limiter import RateLimitedAdapter
+
+# Headers describing the encoding of the original body, which no longer applies to the stored decoded content.
+UNCACHED_HEADERS = ('Content-Encoding', 'Content-Length', 'Transfer-Encoding')
+AUTHORIZATION_HEADERS = ('Authorization', 'PRIVATE-TOKEN', 'JOB-TOKEN')
+
+
+class ResponseCache:
+    """On-disk store of GET responses with their ETag / Last-Modified, bounded in size with LRU eviction."""
+    def __init__(self, cache_dir, max_bytes):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(cache_dir, 'http_cache.db'), check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                                    'key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, '
+                                    'body BLOB, size INTEGER, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(request):
+        # Responses depend on who asks, so the credentials are part of the key, hashed.
+        credentials = '|'.join(request.headers.get(name, '') for name in AUTHORIZATION_HEADERS)
+        return hashlib.sha256(f"{request.url}|{credentials}".encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT etag, last_modified, headers, body FROM responses WHERE key = ?',
+                                          (key,)).fetchone()
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        etag, last_modified, headers, body = row
+        return etag, last_modified, json.loads(headers), body
+
+    def put(self, key, response):
+        headers = {name: value for name, value in response.headers.items() if name not in UNCACHED_HEADERS}
+        body = response.content
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self.lock, self.connection:
+            previous = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.size -= previous[0] if previous else 0
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (key, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                                     json.dumps(headers), body, size, time.time()))
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted_size = self.connection.execute(
+                    'SELECT key, size FROM responses ORDER BY last_used LIMIT 1').fetchone()
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (evicted_key,))
+                self.size -= evicted_size
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class CachingAdapter(RateLimitedAdapter):
+    """Sends GET requests as conditional requests and answers 304 Not Modified from the ResponseCache."""
+    def __init__(self, cache, limiter=None, **kwargs):
+        super().__init__(limiter, **kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+
+        key = self.cache.key(request)
+        cached = self.cache.get(key)
+        if cached is not None:
+            etag, last_modified, _, _ = cached
+            if etag:
+                request.headers['If-None-Match'] = etag
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            METRICS.count('api_cache_hits')
+            return self._cached_response(request, response, cached)
+        if response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            self.cache.put(key, response)
+        return response
+
+    def _cached_response(self, request, not_modified, cached):
+        _, _, headers, body = cached
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(headers)
+        # Rate limit and date headers of the 304 are the current ones.
+        response.headers.update((name, value) for name, value in not_modified.headers.items()
+                                if name not in UNCACHED_HEADERS)
+        response._content = body
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = not_modified.elapsed
+        not_modified.close()
+        return response
+
+
+def mounted_session(adapter):
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -0,0 +1,94 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class IngestionJob:
+    """Pending work of one project: the commit ranges pushed per branch, or a full ingestion since its watermark."""
+    __slots__ = ('project_id', 'project_name', 'pending', 'ranges', 'full', 'queued_at')
+
+    def __init__(self, project_id, project_name=None, pending=0, ranges=None, full=False):
+        self.project_id = project_id
+        self.project_name = project_name
+        self.pending = pending
+        self.ranges = ranges or {}
+        self.full = full
+        self.queued_at = time.monotonic()
+
+    def merge(self, other):
+        self.pending += other.pending
+        self.full = self.full or other.full
+        for branch, (before, after) in other.ranges.items():
+            # Consecutive pushes to a branch make one range, from the oldest before to the newest after.
+            if branch in self.ranges:
+                self.ranges[branch] = (self.ranges[branch][0], after)
+            else:
+                self.ranges[branch] = (before, after)
+
+
+class IngestionScheduler:
+    """Deduplicating priority queue of ingestion jobs, the project with the most pending commits first.
+
+    Jobs pushed for a project already waiting are merged into its job. Jobs pushed for a project being
+    ingested wait until done() is called for it, so a project is never ingested by two workers at once.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.waiting = {}
+        self.running = set()
+        self.deferred = {}
+        self.sequence = itertools.count()
+        self.closed = False
+
+    def push(self, job):
+        with self.condition:
+            if job.project_id in self.running:
+                self._merge(self.deferred, job)
+                return
+            self._merge(self.waiting, job)
+            merged = self.waiting[job.project_id]
+            # Older entries of the project stay in the heap and are skipped once popped.
+            heapq.heappush(self.heap, (-merged.pending, merged.queued_at, next(self.sequence), merged.project_id))
+            self.condition.notify()
+
+    def pop(self):
+        """Blocks until a job is ready, returns None once the scheduler is closed.
+
+        Jobs still waiting when it is closed are dropped, the first poll after a restart picks them up.
+        """
+        with self.condition:
+            while not self.closed:
+                while self.heap:
+                    pending, _, _, project_id = heapq.heappop(self.heap)
+                    job = self.waiting.get(project_id)
+                    if job is not None and -pending == job.pending:
+                        del self.waiting[project_id]
+                        self.running.add(project_id)
+                        return job
+                self.condition.wait()
+            return None
+
+    def done(self, job):
+        with self.condition:
+            self.running.discard(job.project_id)
+            deferred = self.deferred.pop(job.project_id, None)
+        if deferred is not None:
+            self.push(deferred)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.waiting) + len(self.deferred)
+
+    @staticmethod
+    def _merge(jobs, job):
+        if job.project_id in jobs:
+            jobs[job.project_id].merge(job)
+        else:
+            jobs[job.project_id] = job
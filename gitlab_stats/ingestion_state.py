@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from sha_index import ShaSet
+from time_util import as_utc
+
+
+class IngestionState:
+    """Local record of what has been ingested, so incremental runs don't need to read it back from the store.
+
+    For each project it keeps the latest ingested commit time (the high-water mark), the project
+    activity time seen by the last complete run, and the set of ingested commit SHAs, stored as
+    20-byte digests.
+    """
+    def __init__(self, state_dir):
+        os.makedirs(state_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(state_dir, 'ingestion_state.db'), check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS watermarks ('
+                                    'project TEXT PRIMARY KEY, latest TEXT)')
+            if 'activity' not in [column[1] for column in self.connection.execute('PRAGMA table_info(watermarks)')]:
+                self.connection.execute('ALTER TABLE watermarks ADD COLUMN activity TEXT')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS commits ('
+                                    'project TEXT, sha BLOB, PRIMARY KEY (project, sha)) WITHOUT ROWID')
+
+    def has_project(self, project_name):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM watermarks WHERE project = ?', (project_name,)).fetchone()
+        return row is not None
+
+    def latest_commit(self, project_name):
+        with self.lock:
+            row = self.connection.execute('SELECT latest FROM watermarks WHERE project = ?', (project_name,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+    def activity(self, project_name):
+        with self.lock:
+            row = self.connection.execute('SELECT activity FROM watermarks WHERE project = ?', (project_name,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+    def record_activity(self, project_name, activity):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE watermarks SET activity = ? WHERE project = ?',
+                                    (activity.isoformat(), project_name))
+
+    def commit_ids(self, project_name):
+        # Streamed from the cursor, the rows of a large project are never all held at once.
+        with self.lock:
+            rows = self.connection.execute('SELECT sha FROM commits WHERE project = ?', (project_name,))
+            return ShaSet.from_digests(row[0] for row in rows)
+
+    def rebuild(self, project_name, latest, commit_ids):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM commits WHERE project = ?', (project_name,))
+            self.connection.execute('INSERT INTO watermarks (project, latest) VALUES (?, ?) '
+                                    'ON CONFLICT (project) DO UPDATE SET latest = excluded.latest',
+                                    (project_name, latest.isoformat() if latest else None))
+            self.connection.executemany('INSERT OR IGNORE INTO commits (project, sha) VALUES (?, ?)',
+                                        ((project_name, bytes.fromhex(sha)) for sha in commit_ids))
+
+    def record_commits(self, project_name, commits):
+        """Records the SHAs of written commits, the watermark only moves with advance_latest()."""
+        if not commits:
+            return
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO watermarks (project) VALUES (?)', (project_name,))
+            self.connection.executemany('INSERT OR IGNORE INTO commits (project, sha) VALUES (?, ?)',
+                                        ((project_name, bytes.fromhex(commit.sha)) for commit in commits))
+
+    def advance_latest(self, project_name, latest):
+        """Raises the watermark of a project to latest, once all its commits up to there are written."""
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT latest FROM watermarks WHERE project = ?', (project_name,)).fetchone()
+            if row and row[0] and as_utc(row[0]) >= as_utc(latest):
+                return
+            self.connection.execute('INSERT INTO watermarks (project, latest) VALUES (?, ?) '
+                                    'ON CONFLICT (project) DO UPDATE SET latest = excluded.latest',
+                                    (project_name, latest.isoformat()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
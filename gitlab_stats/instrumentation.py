@@ -0,0 +1,205 @@
+import cProfile
+import os
+import pstats
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRIC_PREFIX = 'gitlab_stats'
+LABEL_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+
+class Metrics:
+    """Counters and stage timers of an ingestion run, labelled with the project they were recorded for.
+
+    The project defaults to the one the current thread is working on, so the HTTP adapters and the
+    stores count without being told which project a call is made for.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {}
+        self.timers = {}
+
+    def current_project(self):
+        return getattr(self.local, 'project', None)
+
+    @contextmanager
+    def project(self, project_name):
+        previous = self.current_project()
+        self.local.project = project_name
+        try:
+            yield
+        finally:
+            self.local.project = previous
+
+    def bind(self, function):
+        """Runs function with the current thread's project, for work handed over to an executor."""
+        project_name = self.current_project()
+        def bound(*args, **kwargs):
+            with self.project(project_name):
+                return function(*args, **kwargs)
+        return bound
+
+    def count(self, name, value=1, project=None):
+        key = (name, project or self.current_project() or '')
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds, calls=1, project=None):
+        key = (stage, project or self.current_project() or '')
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, stage, project=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, project=project)
+
+    def timed_iter(self, stage, iterable):
+        """Yields from iterable and records the time spent waiting for its items as one observation."""
+        seconds, iterator = 0.0, iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started
+                yield item
+        finally:
+            self.observe(stage, seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters), {key: tuple(timer) for key, timer in self.timers.items()}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def stage_report(self):
+        _, timers = self.snapshot()
+        stages = {}
+        for (stage, _), (calls, seconds) in timers.items():
+            totals = stages.setdefault(stage, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+        return "Stage times: " + ', '.join(f"{stage} {seconds:.1f}s ({calls} calls)"
+                                           for stage, (calls, seconds) in sorted(stages.items()))
+
+    def prometheus_text(self):
+        counters, timers = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f"{metric}{_labels(project=project)} {value}"
+                         for (counter, project), value in sorted(counters.items()) if counter == name)
+        for suffix, index in (('stage_seconds_total', 1), ('stage_calls_total', 0)):
+            metric = f"{METRIC_PREFIX}_{suffix}"
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f"{metric}{_labels(stage=stage, project=project)} {timer[index]}"
+                         for (stage, project), timer in sorted(timers.items()))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_file(self, path):
+        # Written aside and renamed, so the node exporter textfile collector never reads half a file.
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary, path)
+
+    def records(self):
+        """Timestream style records of the counters and timers, to write them into the metrics store."""
+        counters, timers = self.snapshot()
+        timestamp = str(int(time.time()))
+        host = {'Name': 'host', 'Value': socket.gethostname()}
+        values = [(name, [], project, value) for (name, project), value in counters.items()]
+        values.extend(('stage_seconds', [{'Name': 'stage', 'Value': stage}], project, seconds)
+                      for (stage, project), (_, seconds) in timers.items())
+        for name, dimensions, project, value in values:
+            if project:
+                dimensions = dimensions + [{'Name': 'project', 'Value': project}]
+            yield {
+                'Dimensions': [host] + dimensions,
+                'MeasureName': f"ingestion_{name}",
+                'MeasureValue': str(value),
+                'MeasureValueType': 'DOUBLE',
+                'Time': timestamp,
+                'TimeUnit': 'SECONDS'
+            }
+
+
+def _labels(**labels):
+    pairs = [f'{name}="{str(value).translate(LABEL_ESCAPES)}"' for name, value in labels.items() if value]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        payload = METRICS.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve_metrics(port):
+    """Serves the metrics in Prometheus text format on /metrics from a daemon thread, until shutdown()."""
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"Serving metrics on port {server.server_address[1]}.")
+    return server
+
+
+class Profiler:
+    """cProfile for the fetcher and writer threads as well, which a profile of the main thread doesn't see."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+
+    def wrap(self, function):
+        def profiled(*args, **kwargs):
+            profile = getattr(self.local, 'profile', None)
+            if profile is None:
+                profile = self.local.profile = cProfile.Profile()
+                with self.lock:
+                    self.profiles.append(profile)
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+        return profiled
+
+    def dump(self, path):
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+        print(f"Wrote profile of {len(profiles)} threads to {path}.")
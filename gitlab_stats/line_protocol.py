@@ -0,0 +1,50 @@
+# The escapes of influxdb_client's Point, so the lines are the ones Point.to_line_protocol() writes.
+MEASUREMENT_ESCAPES = str.maketrans({',': '\\,', ' ': '\\ ', '\n': '\\n', '\t': '\\t', '\r': '\\r'})
+TAG_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ ', '\n': '\\n', '\t': '\\t', '\r': '\\r'})
+STRING_FIELD_ESCAPES = str.maketrans({'"': '\\"', '\\': '\\\\'})
+
+# Commits of a project repeat a handful of tag sets, so their escaped prefixes are kept between records.
+PREFIX_CACHE_SIZE = 10000
+
+
+class LineProtocolEncoder:
+    """Encodes Timestream style records into InfluxDB line protocol with second precision."""
+    def __init__(self):
+        self.prefixes = {}
+
+    def encode(self, record):
+        if record.get('MeasureValueType') == 'MULTI':
+            fields = ','.join(f"{measure['Name'].translate(TAG_ESCAPES)}={encode_field(measure['Value'], measure['Type'])}"
+                              for measure in record['MeasureValues'])
+        else:
+            fields = f"value={encode_field(record['MeasureValue'], 'VARCHAR')}"
+        return f"{self.prefix(record)} {fields} {record['Time']}"
+
+    def prefix(self, record):
+        dimensions = record['Dimensions']
+        key = (record['MeasureName'],) + tuple((d['Name'], d['Value']) for d in dimensions)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            if len(self.prefixes) >= PREFIX_CACHE_SIZE:
+                self.prefixes.clear()
+            # Empty tag values are not valid line protocol, the point is written without that tag.
+            tags = ''.join(f",{name.translate(TAG_ESCAPES)}={escape_tag_value(value)}"
+                           for name, value in sorted(key[1:]) if value)
+            prefix = self.prefixes[key] = record['MeasureName'].translate(MEASUREMENT_ESCAPES) + tags
+        return prefix
+
+
+def escape_tag_value(value):
+    escaped = value.translate(TAG_ESCAPES)
+    # A trailing backslash would escape the comma or space after the value.
+    return escaped + ' ' if escaped.endswith('\\') else escaped
+
+
+def encode_field(value, value_type):
+    if value_type == 'BIGINT':
+        return f"{value}i"
+    if value_type == 'DOUBLE':
+        return value
+    if value_type == 'BOOLEAN':
+        return 'true' if value.lower() == 'true' else 'false'
+    return f"\"{value.translate(STRING_FIELD_ESCAPES)}\""
@@ -1,24 +1,104 @@
 import argparse
-import boto3
 import json
-from datetime import datetime
+import re
+import sqlite3
+from datetime import datetime, timezone
+
+from iter_util import batched
+from metrics_store_ts import TimestreamMetricsStore
+
+# Team of employees missing from one side of a snapshot diff, Timestream dimensions can't be empty.
+NO_TEAM = 'none'
+READ_CHUNK_SIZE = 1 << 16
+# Whitespace and the comma between two items, as the items of JSON lines have none.
+ITEM_SEPARATOR = re.compile(r'\s*,?\s*')
+DIFF_BATCH_SIZE = 500
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Capture employee team changes and write to Timestream')
-    parser.add_argument('-f', '--file', required=True, help='Path to the JSON file containing employee data')
+    parser.add_argument('-f', '--file', required=True, help='Path to the JSON file containing employee data, a JSON array or JSON lines; gitlab_stats.py --team-file also needs an author field, the name commits are authored with')
     parser.add_argument('-r', '--region', required=False, help='AWS Region', default="us-west-2")
     parser.add_argument('-d', '--database', required=True, help='Timestream Database')
     parser.add_argument('-t', '--table', required=True, help='Timestream Table')
     parser.add_argument('-a', '--aws-access-key', required=True, help='Amazon Timestream Access Key')
     parser.add_argument('-s', '--aws-access-secret', required=True, help='Amazon Timestream Access Secret')
+    parser.add_argument('-i', '--input-type', required=False, choices=['changes', 'snapshot'], help='Team changes with old_team, new_team and timestamp, or a full snapshot of employee_id and team', default='changes')
+    parser.add_argument('--snapshot-db', required=False, help='SQLite file keeping the last snapshot, snapshots are diffed against it', default='team_snapshot.db')
+    parser.add_argument('--snapshot-time', required=False, help='Time of the snapshot changes, e.g. 2024-01-31T00:00:00, now by default')
+    parser.add_argument('--write-concurrency', required=False, type=int, help='Concurrent WriteRecords requests', default=4)
+    parser.add_argument('--max-retries', required=False, type=int, help='Retries of a throttled write', default=5)
+    parser.add_argument('--dead-letter-file', required=False, help='JSON lines file receiving records Timestream rejected')
     return parser.parse_args()
 
 
-def build_timestream_client(args, name):
-    return boto3.client(name,
-                        region_name=args.region,
-                        aws_access_key_id=args.aws_access_key,
-                        aws_secret_access_key=args.aws_access_secret)
+def read_json_items(path):
+    """Yields the items of a JSON array or of JSON lines without loading the whole file.
+
+    Items are decoded at an offset into the chunk read last, which is only cut when the rest of it is
+    carried over to the next read.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer = f.read(READ_CHUNK_SIZE).lstrip()
+        in_array = buffer.startswith('[')
+        offset = 1 if in_array else 0
+        while True:
+            offset = ITEM_SEPARATOR.match(buffer, offset).end()
+            if in_array and buffer.startswith(']', offset):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, offset)
+            except ValueError:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    if offset < len(buffer):
+                        raise
+                    return
+                buffer, offset = buffer[offset:] + chunk, 0
+                continue
+            # An item ending right at the end of the buffer may be a number cut in two.
+            if end == len(buffer):
+                chunk = f.read(READ_CHUNK_SIZE)
+                if chunk:
+                    buffer, offset = buffer[offset:] + chunk, 0
+                    continue
+            yield item
+            offset = end
+
+
+class TeamSnapshot:
+    """Team of every employee as of the last snapshot, diffed against the next one without holding either in memory."""
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS teams (employee_id TEXT PRIMARY KEY, team TEXT NOT NULL) WITHOUT ROWID')
+        self.connection.execute('CREATE TEMP TABLE next_teams (employee_id TEXT PRIMARY KEY, team TEXT NOT NULL) WITHOUT ROWID')
+
+    def diff(self, employees):
+        """Yields (employee_id, old_team, new_team) for employees who moved, joined or left."""
+        for batch in batched(employees, DIFF_BATCH_SIZE):
+            teams = {employee['employee_id']: employee.get('team') or NO_TEAM for employee in batch}
+            placeholders = ','.join('?' * len(teams))
+            previous = dict(self.connection.execute(
+                f'SELECT employee_id, team FROM teams WHERE employee_id IN ({placeholders})', list(teams)))
+            self.connection.executemany('INSERT OR REPLACE INTO next_teams VALUES (?, ?)', teams.items())
+            for employee_id, team in teams.items():
+                old_team = previous.get(employee_id, NO_TEAM)
+                if old_team != team:
+                    yield employee_id, old_team, team
+        left = self.connection.execute('SELECT employee_id, team FROM teams WHERE employee_id NOT IN '
+                                       '(SELECT employee_id FROM next_teams) AND team != ?', (NO_TEAM,))
+        for employee_id, team in left:
+            yield employee_id, team, NO_TEAM
+
+    def commit(self):
+        """Makes the diffed snapshot the last one, once its changes have been written."""
+        with self.connection:
+            self.connection.execute('DELETE FROM teams')
+            self.connection.execute('INSERT INTO teams SELECT employee_id, team FROM next_teams')
+        self.connection.execute('DELETE FROM next_teams')
+
+    def close(self):
+        self.connection.close()
 
 
 def create_timestream_table(args, client):
@@ -40,47 +120,63 @@ def create_timestream_table(args, client):
         except Exception as e:
             print(f"Failed to create table {args.table}: {str(e)}")
 
-def write_team_changes_to_timestream(args, client, team_changes):
-    records = []
+def team_change_record(employee_id, old_team, new_team, time):
+    return {
+        'Dimensions': [
+            {'Name': 'employee_id', 'Value': employee_id},
+            {'Name': 'old_team', 'Value': old_team},
+            {'Name': 'new_team', 'Value': new_team}
+        ],
+        'MeasureName': 'team_change',
+        'MeasureValue': '1',
+        'MeasureValueType': 'BIGINT',
+        'Time': str(int(round(time.timestamp()))),
+        'TimeUnit': 'SECONDS'
+    }
+
+def change_records(team_changes, counter):
     for change in team_changes:
         time = datetime.strptime(change['timestamp'], '%Y-%m-%dT%H:%M:%S')
-        record = {
-            'Dimensions': [
-                {'Name': 'employee_id', 'Value': change['employee_id']},
-                {'Name': 'old_team', 'Value': change['old_team']},
-                {'Name': 'new_team', 'Value': change['new_team']}
-            ],
-            'MeasureName': 'team_change',
-            'MeasureValue': '1',
-            'MeasureValueType': 'BIGINT',
-            'Time': str(int(round(time.timestamp()))),
-            'TimeUnit': 'SECONDS'
-        }
-        records.append(record)
+        counter[0] += 1
+        yield team_change_record(change['employee_id'], change['old_team'], change['new_team'], time)
 
+def snapshot_records(snapshot, employees, time, counter):
+    for employee_id, old_team, new_team in snapshot.diff(employees):
+        counter[0] += 1
+        yield team_change_record(employee_id, old_team, new_team, time)
+
+def write_team_changes_to_timestream(args, store, records, counter):
+    """Writes the records in chunks of at most 100, several at a time, retrying throttled chunks."""
     try:
-        client.write_records(
-            DatabaseName=args.database,
-            TableName=args.table,
-            Records=records
-        )
-        print(f"Successfully wrote {len(records)} records to Timestream.")
+        store.write_records(records, args.database, args.table)
+        print(f"Successfully wrote {counter[0]} records to Timestream.")
+        return True
     except Exception as e:
-        print(f"Failed to write records to Amazon Timestream: {str(e)}")
+        print(f"Failed to write records to Amazon Timestream after {counter[0]} changes: {str(e)}")
+        return False
 
 def main():
     args = parse_arguments()
 
-    with open(args.file, 'r') as f:
-        team_changes = json.load(f)
-
-    client = build_timestream_client(args, 'timestream-write')
+    store = TimestreamMetricsStore(args.region, args.aws_access_key, args.aws_access_secret,
+                                   args.write_concurrency, args.max_retries, args.dead_letter_file)
 
-    create_timestream_table(args, client)
+    create_timestream_table(args, store.write_client)
 
-    write_team_changes_to_timestream(args, client, team_changes)
+    counter = [0]
+    if args.input_type == 'snapshot':
+        time = datetime.fromisoformat(args.snapshot_time) if args.snapshot_time else datetime.now(timezone.utc)
+        snapshot = TeamSnapshot(args.snapshot_db)
+        records = snapshot_records(snapshot, read_json_items(args.file), time, counter)
+        if write_team_changes_to_timestream(args, store, records, counter):
+            snapshot.commit()
+        else:
+            print(f"Kept the previous snapshot in {args.snapshot_db}, the next run diffs against it again.")
+        snapshot.close()
+    else:
+        write_team_changes_to_timestream(args, store, change_records(read_json_items(args.file), counter), counter)
 
-    client.close()
+    store.close()
 
 if __name__ == '__main__':
     main()
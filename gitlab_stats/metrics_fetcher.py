@@ -6,5 +6,23 @@ class MetricsFetcher(ABC):
         pass
 
     @abstractmethod
-    def fetch_commits(self, project, since, all_branches):
+    def fetch_commits(self, project, since, all_branches, known_commits=frozenset()):
+        """Lazily yields models.Commit, one API page at a time, once per SHA and skipping known_commits."""
         pass
+
+    def fetch_commit_range(self, project, branch, before, after, since, known_commits=frozenset()):
+        """Lazily yields the commits a push moved branch over, from before (excluded) to after.
+
+        Before is the null SHA when the push created the branch, its commits are then the ones not on the
+        default branch. Fetchers without range queries list every branch since the watermark instead.
+        """
+        return self.fetch_commits(project, since, True, known_commits)
+
+    def project_activity(self, project):
+        """Time of the latest push or activity in the project as listed by fetch_projects, None if unknown."""
+        return None
+
+
+def is_null_sha(sha):
+    """Push events carry an all-zero SHA as before of a new branch and as after of a deleted one."""
+    return not sha or not sha.strip('0')
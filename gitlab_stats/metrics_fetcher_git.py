@@ -0,0 +1,134 @@
+import os
+import subprocess
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from models import Commit, Project
+from metrics_fetcher import MetricsFetcher, is_null_sha
+
+RECORD_SEPARATOR = '\x1e'
+FIELD_SEPARATOR = '\x1f'
+LOG_FORMAT = f"--format={RECORD_SEPARATOR}%H{FIELD_SEPARATOR}%P{FIELD_SEPARATOR}%an{FIELD_SEPARATOR}%aI{FIELD_SEPARATOR}%B{FIELD_SEPARATOR}"
+
+
+class GitMirrorMetricsFetcher(MetricsFetcher):
+    """Reads projects and commit stats from bare repositories on local disk instead of a REST API.
+
+    Repositories are found as <mirror_dir>/<group>/<name>.git, or <mirror_dir>/<name>.git with the
+    mirror directory name as group. Remotes are cloned into the mirror directory when missing.
+    """
+    def __init__(self, mirror_dir, remotes=None, update=False):
+        self.mirror_dir = os.path.abspath(mirror_dir)
+        self.remotes = remotes or []
+        self.update = update
+
+    def fetch_projects(self):
+        for remote in self.remotes:
+            path = os.path.join(self.mirror_dir, *_remote_path(remote).strip('/').split('/')[-2:])
+            if not path.endswith('.git'):
+                path += '.git'
+            if not os.path.isdir(path):
+                print(f"Cloning {remote} into {path}")
+                self._git(None, 'clone', '--mirror', '--quiet', remote, path)
+
+        projects = []
+        for entry in sorted(os.scandir(self.mirror_dir), key=lambda e: e.name):
+            if _is_bare_repository(entry.path):
+                projects.append(self._project(os.path.basename(self.mirror_dir), entry.path))
+            elif entry.is_dir():
+                projects.extend(self._project(entry.name, child.path)
+                                for child in sorted(os.scandir(entry.path), key=lambda e: e.name)
+                                if _is_bare_repository(child.path))
+        return projects
+
+    def project_activity(self, project):
+        if self.update:
+            # The mirror is only brought up to date when its commits are fetched.
+            return None
+        # Refs are rewritten by every fetch or push that changes them.
+        ref_paths = [os.path.join(project.url, 'packed-refs')]
+        for directory, _, files in os.walk(os.path.join(project.url, 'refs')):
+            ref_paths.extend(os.path.join(directory, name) for name in files)
+        mtimes = [os.path.getmtime(path) for path in ref_paths if os.path.exists(path)]
+        return datetime.fromtimestamp(max(mtimes), timezone.utc) if mtimes else None
+
+    def fetch_commits(self, project, since, all_branches, known_commits=frozenset()):
+        if self.update:
+            self._git(project.url, 'fetch', '--prune', '--quiet', 'origin')
+
+        revisions = ['--branches'] if all_branches else [project.default_branch or 'master']
+        return self._log(project, revisions + [f"--since={since.isoformat()}"], known_commits)
+
+    def fetch_commit_range(self, project, branch, before, after, since, known_commits=frozenset()):
+        # Pushed commits only reach a mirror once it is fetched.
+        self._git(project.url, 'fetch', '--prune', '--quiet', 'origin')
+        if is_null_sha(before):
+            revisions = [after, '--not', project.default_branch or 'master']
+        else:
+            revisions = [f"{before}..{after}"]
+        return self._log(project, revisions, known_commits)
+
+    def _log(self, project, revisions, known_commits):
+        # One streaming pass over the object database, each commit is listed once however many branches reach it.
+        process = subprocess.Popen(['git', f"--git-dir={project.url}", 'log', *revisions, '--numstat',
+                                    '--diff-merges=first-parent', LOG_FORMAT],
+                                   stdout=subprocess.PIPE, encoding='utf-8', errors='replace')
+        try:
+            for entry in _split_records(process.stdout):
+                commit = _parse_commit(entry)
+                if commit.sha not in known_commits:
+                    yield commit
+        finally:
+            process.stdout.close()
+            process.wait()
+        # Not reached when the generator is closed early, git then exits on the broken pipe.
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    def _project(self, group, path):
+        name = os.path.basename(path)
+        name = name[:-len('.git')] if name.endswith('.git') else name
+        default_branch = self._git(path, 'symbolic-ref', '--short', 'HEAD').strip() or 'master'
+        return Project(id=path, name=name, full_name=f"{group}/{name}", description=None, url=path,
+                       default_branch=default_branch)
+
+    def _git(self, git_dir, *args):
+        command = ['git'] + ([f"--git-dir={git_dir}"] if git_dir else []) + list(args)
+        return subprocess.run(command, check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout
+
+
+def _remote_path(remote):
+    """Repository path of a remote URL, of an scp-style remote like git@host:group/name.git, or a local path."""
+    if '://' in remote:
+        return urlparse(remote).path
+    # As git does, a colon before the first slash makes it scp-style rather than a local path.
+    host, colon, path = remote.partition(':')
+    return path if colon and '/' not in host else remote
+
+
+def _is_bare_repository(path):
+    return os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects'))
+
+
+def _split_records(stream):
+    buffer = ''
+    for chunk in iter(lambda: stream.read(1 << 16), ''):
+        buffer += chunk
+        *entries, buffer = buffer.split(RECORD_SEPARATOR)
+        yield from (entry for entry in entries if entry)
+    if buffer:
+        yield buffer
+
+
+def _parse_commit(entry):
+    sha, parents, author, date, message, numstat = entry.split(FIELD_SEPARATOR)
+    additions = deletions = 0
+    for line in numstat.splitlines():
+        added, deleted, _ = (line.split('\t', 2) + ['', ''])[:3]
+        # Binary files are reported as '-'.
+        if added.isdigit():
+            additions += int(added)
+        if deleted.isdigit():
+            deletions += int(deleted)
+    return Commit(sha=sha, author=author, date=datetime.fromisoformat(date), message=message.strip(),
+                  parent_count=len(parents.split()), additions=additions, deletions=deletions)
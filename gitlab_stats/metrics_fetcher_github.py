@@ -1,27 +1,94 @@
-from github import Github, GithubException
+from datetime import timezone
+from github import Consts, Github, GithubException
+from github.Requester import HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass, Requester
 
 from models import Commit
-from metrics_fetcher import MetricsFetcher
+from sha_index import ShaSet
+from metrics_fetcher import MetricsFetcher, is_null_sha
+from time_util import as_utc
 
 class GitHubMetricsFetcher(MetricsFetcher):
-    def __init__(self, access_key):
-        self.client = Github(access_key)
+    def __init__(self, access_key, http_adapter=None, api_url=None):
+        seconds_between_requests = Consts.DEFAULT_SECONDS_BETWEEN_REQUESTS
+        if http_adapter is not None:
+            use_http_adapter(http_adapter)
+            # The adapter's rate limiter paces the requests of all threads, PyGithub's fixed gap per client is on top.
+            seconds_between_requests = None
+        self.client = Github(access_key, base_url=api_url or Consts.DEFAULT_BASE_URL,
+                             seconds_between_requests=seconds_between_requests)
+        self.lazy_client = self.client.withLazy(True)
 
     def fetch_projects(self):
         return self.client.get_user().get_repos()
 
-    def fetch_commits(self, project, since, all_branches):
+    def project_activity(self, project):
+        return as_utc(project.pushed_at) if project.pushed_at else None
+
+    def fetch_commits(self, project, since, all_branches, known_commits=frozenset()):
+        # Rebind the project to this fetcher's client, projects may have been listed by another thread.
+        repo = self.lazy_client.get_repo(project.full_name)
         try:
             if all_branches:
-                branches = project.get_branches()
+                default_branch = project.default_branch or 'master'
+                branches = [branch.name for branch in repo.get_branches() if branch.name != default_branch]
             else:
-                branches = [project.get_branch('master')]
+                default_branch = repo.get_branch('master').name
+                branches = []
         except GithubException as e:
             print(f"Failed to fetch branches for project {project.name}: {str(e)}")
-            return []
+            return
+
+        # Stats cost one extra request per commit, so they are only read for commits not seen or stored yet.
+        seen = ShaSet()
+        for commit in self._branch_commits(repo, default_branch, branches, since):
+            if commit.sha in seen or commit.sha in known_commits:
+                continue
+            seen.add(commit.sha)
+            yield Commit.from_github_commit(commit)
+
+    def fetch_commit_range(self, project, branch, before, after, since, known_commits=frozenset()):
+        repo = self.lazy_client.get_repo(project.full_name)
+        start = (project.default_branch or 'master') if is_null_sha(before) else before
+        for commit in repo.compare(start, after).commits:
+            if commit.sha not in known_commits:
+                yield Commit.from_github_commit(commit)
 
-        commits = []
+    def _branch_commits(self, repo, default_branch, branches, since):
+        yield from repo.get_commits(sha=default_branch, since=since)
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
         for branch in branches:
-            commits.extend(project.get_commits(sha=branch.name, since=since))
+            # The comparison only lists the commits the branch adds on top of the default branch.
+            for commit in repo.compare(default_branch, branch).commits:
+                if commit.commit.author.date >= since:
+                    yield commit
+
+
+def use_http_adapter(adapter):
+    """Routes PyGithub requests through the given adapter, PyGithub has no per-client session to mount it on.
+
+    Closing a connection closes the adapters mounted on its session, so the connections put PyGithub's own
+    adapter back first; the shared one and its pool stay open for the other clients.
+    """
+    class HTTPConnection(HTTPRequestsConnectionClass):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.session.mount('http://', adapter)
+
+        def close(self):
+            self.session.mount('http://', self.adapter)
+            super().close()
+
+    class HTTPSConnection(HTTPSRequestsConnectionClass):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.session.mount('https://', adapter)
+
+        def close(self):
+            self.session.mount('https://', self.adapter)
+            super().close()
 
-        return [Commit.from_github_commit(commit) for commit in commits]
\ No newline at end of file
+    Requester.injectConnectionClasses(HTTPConnection, HTTPSConnection)
+    # Injecting turns off reusing each client's connection for the requests that follow, which is only
+    # meant for connection classes that can't be reused; these can.
+    Requester._Requester__persist = True
@@ -0,0 +1,108 @@
+import requests
+
+from datetime import timezone
+
+from http_cache import mounted_session
+from metrics_fetcher_github import GitHubMetricsFetcher
+from models import Commit
+from sha_index import ShaSet
+
+BRANCHES_QUERY = '''
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    refs(refPrefix: "refs/heads/", first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name }
+    }
+  }
+}
+'''
+
+HISTORY_QUERY = '''
+query($owner: String!, $name: String!, $ref: String!, $since: GitTimestamp, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    ref(qualifiedName: $ref) {
+      target {
+        ... on Commit {
+          history(first: 100, since: $since, after: $cursor) {
+            pageInfo { hasNextPage endCursor }
+            nodes {
+              oid
+              message
+              additions
+              deletions
+              author { name date }
+              parents(first: 100) { nodes { oid } }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+
+class GitHubGraphQLMetricsFetcher(GitHubMetricsFetcher):
+    """Fetches commit history through the GraphQL API, 100 commits with their stats per request.
+
+    Projects are still listed through the REST API by GitHubMetricsFetcher.
+    """
+    def __init__(self, access_key, http_adapter=None, api_url=None):
+        super().__init__(access_key, http_adapter, api_url)
+        # Next to the REST API, e.g. https://github.example.com/api/graphql for https://github.example.com/api/v3.
+        self.graphql_url = self.client.requester.graphql_url
+        self.session = mounted_session(http_adapter) if http_adapter is not None else requests.Session()
+        self.session.headers['Authorization'] = f"bearer {access_key}"
+
+    def fetch_commits(self, project, since, all_branches, known_commits=frozenset()):
+        owner, name = project.full_name.split('/')
+        default_branch = (project.default_branch or 'master') if all_branches else 'master'
+        branches = [default_branch]
+        if all_branches:
+            branches += [branch for branch in self._branches(owner, name) if branch != default_branch]
+
+        seen = ShaSet()
+        for branch in branches:
+            for page in self._history(owner, name, branch, since):
+                new_commits = [node for node in page if node['oid'] not in seen]
+                if branch != default_branch and not new_commits:
+                    # A whole page of already listed commits, the rest of this branch is shared history.
+                    break
+                for node in new_commits:
+                    seen.add(node['oid'])
+                    if node['oid'] not in known_commits:
+                        yield Commit.from_github_graphql_commit(node)
+
+    def _branches(self, owner, name):
+        cursor = None
+        while True:
+            refs = self._query(BRANCHES_QUERY, owner=owner, name=name, cursor=cursor)['repository']['refs']
+            yield from (node['name'] for node in refs['nodes'])
+            if not refs['pageInfo']['hasNextPage']:
+                return
+            cursor = refs['pageInfo']['endCursor']
+
+    def _history(self, owner, name, branch, since):
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc)
+        cursor = None
+        while True:
+            ref = self._query(HISTORY_QUERY, owner=owner, name=name, ref=f"refs/heads/{branch}",
+                              since=since.strftime('%Y-%m-%dT%H:%M:%SZ'), cursor=cursor)['repository']['ref']
+            if ref is None:
+                print(f"Branch {branch} not found in project {owner}/{name}")
+                return
+            history = ref['target']['history']
+            yield history['nodes']
+            if not history['pageInfo']['hasNextPage']:
+                return
+            cursor = history['pageInfo']['endCursor']
+
+    def _query(self, query, **variables):
+        response = self.session.post(self.graphql_url, json={'query': query, 'variables': variables})
+        response.raise_for_status()
+        body = response.json()
+        if body.get('errors'):
+            raise RuntimeError(f"GitHub GraphQL query failed: {body['errors']}")
+        return body['data']
@@ -1,26 +1,51 @@
 import gitlab
 
 from attr_util import set_attributes_for_collection
+from http_cache import mounted_session
 from models import Commit
-from metrics_fetcher import MetricsFetcher
+from sha_index import ShaSet
+from metrics_fetcher import MetricsFetcher, is_null_sha
+from time_util import as_utc
 
 class GitLabMetricsFetcher(MetricsFetcher):
-    def __init__(self, url, access_key):
-        self.client = gitlab.Gitlab(url, private_token=access_key)
+    def __init__(self, url, access_key, http_adapter=None):
+        if http_adapter is not None:
+            self.client = gitlab.Gitlab(url, private_token=access_key, session=mounted_session(http_adapter))
+        else:
+            self.client = gitlab.Gitlab(url, private_token=access_key)
 
     def fetch_projects(self):
         projects = self.client.projects.list(all=True)
         set_attributes_for_collection(projects, full_name=lambda project: project.name_with_namespace.lower())
         return projects
 
-    def fetch_commits(self, project, since, all_branches):
+    def project_activity(self, project):
+        return as_utc(project.last_activity_at) if getattr(project, 'last_activity_at', None) else None
+
+    def fetch_commits(self, project, since, all_branches, known_commits=frozenset()):
+        # Rebind the project to this fetcher's client, projects may have been listed by another thread.
+        remote_project = self.client.projects.get(project.id, lazy=True)
         if all_branches:
-            branches = project.branches.list(all=True)
+            # Walk the default branch once, then only the commits each branch adds on top of it,
+            # instead of re-listing the shared history for every branch.
+            default_branch = project.default_branch or 'master'
+            refs = [default_branch] + [f"{default_branch}..{branch.name}"
+                                       for branch in remote_project.branches.list(iterator=True)
+                                       if branch.name != default_branch]
         else:
-            branches = [project.branches.get('master')]
+            refs = [remote_project.branches.get('master').name]
+
+        seen = ShaSet()
+        for ref in refs:
+            for commit in remote_project.commits.list(iterator=True, with_stats=True, since=since, ref_name=ref):
+                if commit.id in seen or commit.id in known_commits:
+                    continue
+                seen.add(commit.id)
+                yield Commit.from_gitlab_commit(commit)
 
-        commits = [commit
-                   for branch in branches
-                   for commit in project.commits.list(all=True, with_stats=True, since=since, ref_name=branch.name)
-                   ]
-        return [Commit.from_gitlab_commit(commit) for commit in commits]
+    def fetch_commit_range(self, project, branch, before, after, since, known_commits=frozenset()):
+        remote_project = self.client.projects.get(project.id, lazy=True)
+        start = (project.default_branch or 'master') if is_null_sha(before) else before
+        for commit in remote_project.commits.list(iterator=True, with_stats=True, ref_name=f"{start}..{after}"):
+            if commit.id not in known_commits:
+                yield Commit.from_gitlab_commit(commit)
@@ -0,0 +1,63 @@
+import time
+
+from time_util import within_retention
+
+ROLLUP_MEASURE = 'daily_commits'
+ROLLUP_MEASURES = ('commits', 'additions', 'deletions', 'changed_lines')
+SECONDS_PER_DAY = 24 * 60 * 60
+# Measures of this size are vendored or generated code, the dashboards leave them out of commit sizes.
+LARGE_CHANGE_LINES = 10000
+
+
+class DailyRollups:
+    """Commit totals per project, day, author and parent count of the commits written during a run."""
+    def __init__(self):
+        self.projects = {}
+
+    def add(self, project, commits):
+        group, _ = project.full_name.split('/')
+        buckets = self.projects.setdefault(project.name, {})
+        for commit in commits:
+            if not within_retention(commit.date):
+                continue
+            day = int(commit.date.timestamp()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+            totals = buckets.setdefault((group, commit.author, str(commit.parent_count), day), [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += commit.additions
+            totals[2] += commit.deletions
+            totals[3] += sum(lines for lines in (commit.additions, commit.deletions) if lines < LARGE_CHANGE_LINES)
+
+    def pop(self, project_name):
+        return self.projects.pop(project_name, {})
+
+    def project_names(self):
+        return list(self.projects)
+
+
+def merge_rollups(buckets, stored):
+    return {key: [a + b for a, b in zip(totals, stored.get(key, (0, 0, 0, 0)))] for key, totals in buckets.items()}
+
+
+def rollup_records(project_name, buckets, team_index=None):
+    # Timestream keeps the record with the highest version, InfluxDB the last point written for a series and time.
+    version = time.time_ns() // 1000
+    for (group, author, parents, day), totals in buckets.items():
+        dimensions = [
+            {'Name': 'project', 'Value': project_name},
+            {'Name': 'group', 'Value': group},
+            {'Name': 'author', 'Value': author},
+            {'Name': 'parents', 'Value': parents}
+        ]
+        if team_index is not None:
+            # Team at the end of the day, the team a member moved to on that day.
+            dimensions.append({'Name': 'team', 'Value': team_index.team_at(author, day + SECONDS_PER_DAY - 1)})
+        yield {
+            'Dimensions': dimensions,
+            'MeasureName': ROLLUP_MEASURE,
+            'MeasureValueType': 'MULTI',
+            'MeasureValues': [{'Name': name, 'Value': str(value), 'Type': 'BIGINT'}
+                              for name, value in zip(ROLLUP_MEASURES, totals)],
+            'Time': str(day),
+            'TimeUnit': 'SECONDS',
+            'Version': version
+        }
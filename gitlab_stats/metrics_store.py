@@ -1,5 +1,13 @@
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta, timezone
+from collections import namedtuple
+from metrics_rollup import merge_rollups, rollup_records
+from sha_index import ShaSet
+from time_util import within_retention
+
+# A commit read back from the store, its time in epoch seconds.
+StoredCommit = namedtuple('StoredCommit', ['project', 'group', 'author', 'parents', 'time', 'additions', 'deletions',
+                                           'id', 'message'])
+
 
 class MetricsStore(ABC):
     @abstractmethod
@@ -8,6 +16,15 @@ class MetricsStore(ABC):
 
     @abstractmethod
     def write_records(self, records, database, table):
+        """Writes an iterable of records, flushing fixed-size batches as they arrive."""
+        pass
+
+    def submit_records(self, records, database, table):
+        """Starts writing records, they may still be buffered or in flight until flush() returns."""
+        self.write_records(records, database, table)
+
+    def flush(self):
+        """Waits until the submitted records are written, raising the error of a failed write."""
         pass
 
     @abstractmethod
@@ -19,63 +36,183 @@ class MetricsStore(ABC):
         pass
 
 
+class PreloadedWatermarks:
+    """Watermarks of every project loaded at once, shared by the processors of all threads."""
+    def __init__(self):
+        self.latest_commits = None
+        self.commit_ids = None
+
+
 class MetricsProcessor(ABC):
-    def __init__(self, store):
+    # Whether the store can read back and upsert the daily rollups, checked before a run starts.
+    supports_daily_rollups = True
+
+    def __init__(self, store, multi_measure=False, preloaded=None, team_index=None):
         self.store = store
+        # One MULTI record per commit instead of one record per measure.
+        self.multi_measure = multi_measure
+        self.preloaded = preloaded if preloaded is not None else PreloadedWatermarks()
+        # Adds the team of the author as a dimension, so the dashboards group by team without a join.
+        self.team_index = team_index
+
+    def preload(self, args, with_commit_ids=False):
+        """Loads the watermarks, and optionally the commit ids, of all projects in one query each."""
+        self.preloaded.latest_commits = self.query_all_latest_commits(args)
+        print(f"Preloaded watermarks of {len(self.preloaded.latest_commits)} projects.")
+        if with_commit_ids:
+            self.preloaded.commit_ids = self.query_all_commits_id(args)
 
-    @abstractmethod
     def load_latest_commit(self, args, project_name):
+        if self.preloaded.latest_commits is None:
+            return self.query_latest_commit(args, project_name)
+        latest = self.preloaded.latest_commits.get(project_name)
+        return {project_name: latest} if latest is not None else {}
+
+    def get_all_commits_id(self, args, project_name):
+        if self.preloaded.commit_ids is None:
+            return self.query_commits_id(args, project_name)
+        # Each project is processed once, its ids are handed over instead of copied.
+        return self.preloaded.commit_ids.pop(project_name, ShaSet())
+
+    @abstractmethod
+    def query_latest_commit(self, args, project_name):
         pass
 
     @abstractmethod
-    def get_all_commits_id(self, args, project_name):
+    def query_commits_id(self, args, project_name):
+        pass
+
+    @abstractmethod
+    def query_all_latest_commits(self, args):
+        pass
+
+    @abstractmethod
+    def query_all_commits_id(self, args):
+        pass
+
+    @abstractmethod
+    def migrate_to_multi_measure(self, args):
         pass
 
+    @abstractmethod
+    def query_daily_rollups(self, args, project_name, since):
+        """Returns the rollup totals of a project from the day starting at since, keyed by (group, author, parents, day).
+
+        Raises when the store can't be read, rather than returning no totals.
+        """
+        pass
+
+    def write_daily_rollups(self, args, project_name, buckets):
+        """Upserts the day buckets touched by the commits of a run, adding them to the totals already stored."""
+        if not buckets:
+            return
+        # A reload ingests the whole history again, its buckets replace the stored ones instead of adding to them.
+        if not args.reload:
+            since = min(day for _, _, _, day in buckets)
+            buckets = merge_rollups(buckets, self.query_daily_rollups(args, project_name, since))
+        records = list(rollup_records(project_name, buckets, self.team_index))
+        print(f"Upserting {len(records)} daily rollups of project: {project_name}")
+        self.store.write_records(records, args.database, args.rollup_table)
+
     def process_commit(self, commit, project):
-        commit_id = commit.sha
         group, _ = project.full_name.split('/')
-        time = commit.date
-        author = commit.author
-
-        # Amazon Timestream Table has a 10 years limit (which is configurable), you can't insert data older than 10 years.
-        if time <= (datetime.now(timezone.utc) - timedelta(days=365 * 10)):
+        if not within_retention(commit.date):
             return
+        dimensions = commit_dimensions(project.name, group, commit.author, str(commit.parent_count),
+                                       self.team_of(commit.author, commit.date))
+        yield from commit_records(dimensions, commit.date.timestamp(), commit.additions, commit.deletions,
+                                  commit.sha, commit.message, self.multi_measure)
 
-        dimensions = [
-            {'Name': 'project', 'Value': project.name},
-            {'Name': 'group', 'Value': group},
-            {'Name': 'author', 'Value': author},
-            {'Name': 'parents', 'Value': str(len(commit.parents) if hasattr(commit, 'parents') else 1)}
-        ]
+    def team_of(self, author, time):
+        return self.team_index.team_at(author, time) if self.team_index is not None else None
 
+    @abstractmethod
+    def query_stored_commits(self, args):
+        """Yields lists of the StoredCommit of the table, whether it holds single or multi-measure records."""
+        pass
+
+    def retag_teams(self, args):
+        """Copies the commits of the table into args.retag_table, with the team of their author when they were made.
+
+        The dimensions of stored records can't be changed in place, the dashboards move to the copy once written.
+        """
+        retagged = 0
+        for commits in self.query_stored_commits(args):
+            records = [record for commit in commits for record in commit_records(
+                commit_dimensions(commit.project, commit.group, commit.author, commit.parents,
+                                  self.team_of(commit.author, commit.time)),
+                commit.time, commit.additions, commit.deletions, commit.id, commit.message, self.multi_measure)]
+            self.write_retagged(args, records)
+            retagged += len(commits)
+        print(f"Re-tagged {retagged} commits into {args.retag_table}.")
+
+    def write_retagged(self, args, records):
+        self.store.write_records(records, args.database, args.retag_table)
+
+
+def commit_dimensions(project_name, group, author, parents, team=None):
+    dimensions = [
+        {'Name': 'project', 'Value': project_name},
+        {'Name': 'group', 'Value': group},
+        {'Name': 'author', 'Value': author},
+        {'Name': 'parents', 'Value': parents}
+    ]
+    if team is not None:
+        dimensions.append({'Name': 'team', 'Value': team})
+    return dimensions
+
+
+def commit_records(dimensions, time, additions, deletions, commit_id, message, multi_measure):
+    """Records of a commit made at time, in epoch seconds: one MULTI record, or one record per measure."""
+    timestamp = str(int(round(time)))
+    has_message = message and 1 <= len(message) <= 2048
+
+    if multi_measure:
+        measures = [
+            {'Name': 'additions', 'Value': str(additions), 'Type': 'BIGINT'},
+            {'Name': 'deletions', 'Value': str(deletions), 'Type': 'BIGINT'},
+            {'Name': 'id', 'Value': str(commit_id), 'Type': 'VARCHAR'}
+        ]
+        if has_message:
+            measures.append({'Name': 'message', 'Value': message, 'Type': 'VARCHAR'})
         yield {
             'Dimensions': dimensions,
-            'MeasureName': 'additions',
-            'MeasureValue': str(commit.stats.get('additions', 0)),
-            'Time': str(int(round(time.timestamp()))),
-            'TimeUnit': 'SECONDS'
-        }
-        yield {
-            'Dimensions': dimensions,
-            'MeasureName': 'deletions',
-            'MeasureValue': str(commit.stats.get('deletions', 0)),
-            'Time': str(int(round(time.timestamp()))),
+            'MeasureName': 'commit',
+            'MeasureValueType': 'MULTI',
+            'MeasureValues': measures,
+            'Time': timestamp,
             'TimeUnit': 'SECONDS'
         }
+        return
+
+    yield {
+        'Dimensions': dimensions,
+        'MeasureName': 'additions',
+        'MeasureValue': str(additions),
+        'Time': timestamp,
+        'TimeUnit': 'SECONDS'
+    }
+    yield {
+        'Dimensions': dimensions,
+        'MeasureName': 'deletions',
+        'MeasureValue': str(deletions),
+        'Time': timestamp,
+        'TimeUnit': 'SECONDS'
+    }
+    yield {
+        'Dimensions': dimensions,
+        'MeasureName': 'id',
+        'MeasureValue': str(commit_id),
+        'MeasureValueType': 'VARCHAR',
+        'Time': timestamp,
+        'TimeUnit': 'SECONDS'
+    }
+    if has_message:
         yield {
             'Dimensions': dimensions,
-            'MeasureName': 'id',
-            'MeasureValue': str(commit_id),
+            'MeasureName': 'message',
+            'MeasureValue': message,
             'MeasureValueType': 'VARCHAR',
-            'Time': str(int(round(time.timestamp()))),
+            'Time': timestamp,
             'TimeUnit': 'SECONDS'
         }
-        if commit.message and 1 <= len(commit.message) <= 2048:
-            yield {
-                'Dimensions': dimensions,
-                'MeasureName': 'message',
-                'MeasureValue': commit.message,
-                'MeasureValueType': 'VARCHAR',
-                'Time': str(int(round(time.timestamp()))),
-                'TimeUnit': 'SECONDS'
-            }
\ No newline at end of file
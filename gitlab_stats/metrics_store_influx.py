@@ -1,51 +1,212 @@
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+import threading
+from concurrent import futures
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
-from datetime import datetime
 
-from metrics_store import MetricsStore, MetricsProcessor
+from instrumentation import METRICS
+from line_protocol import LineProtocolEncoder
+from metrics_rollup import ROLLUP_MEASURE, ROLLUP_MEASURES
+from metrics_store import MetricsStore, MetricsProcessor, StoredCommit
+from sha_index import ShaSet
+
+WRITE_BATCH_SIZE = 5000
 
 
 class InfluxDBMetricsStore(MetricsStore):
-    def __init__(self, url, token, org):
-        self.client = InfluxDBClient(url=url, token=token, org=org)
+    def __init__(self, url, token, org, write_mode='sync', batch_size=WRITE_BATCH_SIZE, flush_interval=1.0,
+                 max_inflight=4, gzip=False):
+        self.client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=gzip)
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
         self.query_api = self.client.query_api()
+        self.encoder = LineProtocolEncoder()
+        self.batch_size = batch_size
+        self.batching = write_mode == 'batching'
+        # Lines are buffered per bucket across calls and written batch_size at a time.
+        self.buffers = {}
+        self.buffer_lock = threading.Condition()
+        # Batches taken from the buffers whose write isn't in flight yet, flush waits for them.
+        self.submitting = 0
+        if self.batching:
+            # Batches are written in the background, at most max_inflight at a time.
+            self.inflight = threading.BoundedSemaphore(max_inflight)
+            self.executor = futures.ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix='influxdb-writer')
+            # Batches written since the last flush, which raises their errors.
+            self.futures = set()
+            self.closed = threading.Event()
+            self.flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,),
+                                            name='influxdb-flusher', daemon=True)
+            self.flusher.start()
 
     def create_table(self, database, table, s3_bucket=None):
         # InfluxDB does not require explicit table creation
         pass
 
     def write_records(self, records, database, table):
-        points = []
-        for record in records:
-            point = Point(record['MeasureName']) \
-                .tag("project", record['Dimensions'][0]['Value']) \
-                .tag("group", record['Dimensions'][1]['Value']) \
-                .tag("author", record['Dimensions'][2]['Value']) \
-                .tag("parents", record['Dimensions'][3]['Value']) \
-                .field("value", record['MeasureValue']) \
-                .time(record['Time'], WritePrecision.S)
-            points.append(point)
-        self.write_api.write(bucket=database, record=points)
+        self.submit_records(records, database, table)
+        self.flush()
+
+    def submit_records(self, records, database, table):
+        for line in (self.encoder.encode(record) for record in records):
+            with self.buffer_lock:
+                buffer = self.buffers.setdefault(database, [])
+                buffer.append(line)
+                batch = self.buffers.pop(database) if len(buffer) >= self.batch_size else None
+                if batch:
+                    self.submitting += 1
+            if batch:
+                self._submit(database, batch)
+
+    def flush(self):
+        """Writes the buffered lines, and in batching mode waits for the batches in flight.
+
+        A background write that failed is raised here, so the caller doesn't count its points as written.
+        """
+        self._submit_buffers()
+        if not self.batching:
+            return
+        with self.buffer_lock:
+            # The flusher may have taken lines from the buffers and still wait for a slot to write them.
+            self.buffer_lock.wait_for(lambda: not self.submitting)
+            pending, self.futures = self.futures, set()
+        futures.wait(pending)
+        errors = [future.exception() for future in pending if future.exception()]
+        if errors:
+            raise errors[0]
+
+    def _submit_buffers(self):
+        with self.buffer_lock:
+            buffers, self.buffers = self.buffers, {}
+            self.submitting += len(buffers)
+        for database, batch in buffers.items():
+            self._submit(database, batch)
+
+    def _submit(self, database, batch):
+        future = None
+        try:
+            if not self.batching:
+                self.write_api.write(bucket=database, record=batch, write_precision=WritePrecision.S)
+                METRICS.count('write_requests')
+                return
+            self.inflight.acquire()
+            future = self.executor.submit(self.write_api.write, bucket=database, record=batch,
+                                          write_precision=WritePrecision.S)
+            future.add_done_callback(lambda f: self._written(f, len(batch)))
+        finally:
+            with self.buffer_lock:
+                if future is not None:
+                    self.futures.add(future)
+                self.submitting -= 1
+                self.buffer_lock.notify_all()
+
+    def _written(self, future, count):
+        self.inflight.release()
+        METRICS.count('write_requests')
+        if future.exception():
+            print(f"\t\tFailed to write {count} points to InfluxDB: {str(future.exception())}")
+            METRICS.count('failed_records', count)
+
+    def _flush_periodically(self, flush_interval):
+        while not self.closed.wait(flush_interval):
+            self._submit_buffers()
 
     def query(self, query_string, data_extractor, default_value):
         try:
-            tables = self.query_api.query(query_string)
-            return tables
+            tables = self.query_tables(query_string)
+            if tables:
+                return data_extractor(tables)
+            else:
+                return default_value
         except Exception as e:
             print(f"Exception while running query: {query_string}", e)
-            return []
+            return default_value
+
+    def query_tables(self, query_string):
+        """Runs a Flux query, raising its errors instead of returning a default."""
+        return self.query_api.query(query_string)
 
     def close(self):
+        if self.batching:
+            self.closed.set()
+            self.flusher.join()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Failed to write points to InfluxDB: {str(e)}")
+        if self.batching:
+            self.executor.shutdown()
         self.client.close()
 
+
 class InfluxDBMetricsProcessor(MetricsProcessor):
-    def load_latest_commit(self, args, project_name):
-        query = f'from(bucket: "{args.database}") |> range(start: -10y) |> filter(fn: (r) => r._measurement == "id" and r.project == "{project_name}") |> last()'
-        data_extractor = lambda tables: {record['project']: datetime.strptime(record['_time'], '%Y-%m-%dT%H:%M:%SZ') for table in tables for record in table.records}
+    def query_latest_commit(self, args, project_name):
+        return self.query_all_latest_commits(args, f' and r.project == "{project_name}"')
+
+    def query_commits_id(self, args, project_name):
+        return self.query_all_commits_id(args, f' and r.project == "{project_name}"').get(project_name, ShaSet())
+
+    def query_all_latest_commits(self, args, project_filter=''):
+        query = f'from(bucket: "{args.database}") |> range(start: -10y) |> filter(fn: (r) => {self._id_filter()}{project_filter}) |> group(columns: ["project"]) |> last()'
+        data_extractor = lambda tables: {record['project']: record.get_time() for table in tables for record in table.records}
+        return self.store.query(query, data_extractor, {})
+
+    def query_all_commits_id(self, args, project_filter=''):
+        query = f'from(bucket: "{args.database}") |> range(start: 0) |> filter(fn: (r) => {self._id_filter()}{project_filter}) |> keep(columns: ["project", "_value"])'
+        def data_extractor(tables):
+            commit_ids = {}
+            for table in tables:
+                for record in table.records:
+                    commit_ids.setdefault(record['project'], ShaSet()).add(record['_value'])
+            return commit_ids
         return self.store.query(query, data_extractor, {})
 
-    def get_all_commits_id(self, args, project_name):
-        query = f'from(bucket: "{args.database}") |> range(start: 0) |> filter(fn: (r) => r._measurement == "id" and r.project == "{project_name}") |> keep(columns: ["_value"])'
-        data_extractor = lambda tables: [record['_value'] for table in tables for record in table.records]
-        return set(self.store.query(query, data_extractor, []))
+    def migrate_to_multi_measure(self, args):
+        """Copies the single-measure points of the bucket into 'commit' points with one field per measure.
+
+        Runs server side with to(), the original points are left in place.
+        """
+        source = f'from(bucket: "{args.database}") |> range(start: 0) |> filter(fn: (r) => r._field == "value")'
+        target = f'map(fn: (r) => ({{r with _field: r._measurement, _measurement: "commit"}})) |> to(bucket: "{args.database}")'
+        self.store.query(f'{source} |> filter(fn: (r) => r._measurement == "additions" or r._measurement == "deletions") '
+                         f'|> map(fn: (r) => ({{r with _value: int(v: r._value)}})) |> {target}', lambda tables: tables, None)
+        self.store.query(f'{source} |> filter(fn: (r) => r._measurement == "id" or r._measurement == "message") |> {target}',
+                         lambda tables: tables, None)
+        print(f"Migrated bucket {args.database} to multi-measure points.")
+
+    def query_stored_commits(self, args):
+        if self.multi_measure:
+            source = 'filter(fn: (r) => r._measurement == "commit") |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'
+        else:
+            source = ('filter(fn: (r) => r._field == "value" and contains(value: r._measurement, set: ["additions", "deletions", "id", "message"])) '
+                      '|> pivot(rowKey: ["_time"], columnKey: ["_measurement"], valueColumn: "_value")')
+        # The team of already re-tagged points is left out of the series, the points of a commit pivot into one row.
+        query = f'from(bucket: "{args.database}") |> range(start: 0) |> drop(fn: (column) => column == "team") ' \
+                f'|> group(columns: ["project", "group", "author", "parents"]) |> {source}'
+        def data_extractor(tables):
+            return [StoredCommit(record['project'], record['group'], record['author'], record['parents'],
+                                 record.get_time().timestamp(), int(record.values.get('additions') or 0),
+                                 int(record.values.get('deletions') or 0), record.values.get('id') or '',
+                                 record.values.get('message'))
+                    for table in tables for record in table.records]
+        # One query for the whole bucket, the Flux API has no pages to read it by.
+        yield self.store.query(query, data_extractor, [])
+
+    def write_retagged(self, args, records):
+        # Points go to the bucket of their database, a copy in the same bucket would double every commit.
+        self.store.write_records(records, args.retag_table, args.retag_table)
+
+    def query_daily_rollups(self, args, project_name, since):
+        query = f'from(bucket: "{args.database}") |> range(start: {since}) |> filter(fn: (r) => r._measurement == "{ROLLUP_MEASURE}" and r.project == "{project_name}")'
+        def data_extractor(tables):
+            rollups = {}
+            for table in tables:
+                for record in table.records:
+                    key = (record['group'], record['author'], record['parents'], int(record.get_time().timestamp()))
+                    rollups.setdefault(key, [0] * len(ROLLUP_MEASURES))[ROLLUP_MEASURES.index(record.get_field())] = record.get_value()
+            return rollups
+        # Raises when the read fails, upserting this run's totals alone would replace the stored ones.
+        return data_extractor(self.store.query_tables(query))
+
+    def _id_filter(self):
+        if self.multi_measure:
+            return 'r._measurement == "commit" and r._field == "id"'
+        return 'r._measurement == "id"'
@@ -0,0 +1,182 @@
+import os
+import uuid
+from collections import namedtuple
+from urllib.parse import quote
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from metrics_store import MetricsStore, MetricsProcessor, StoredCommit
+from sha_index import ShaSet
+
+# Rows buffered across all partitions before the largest partition is written out.
+FLUSH_ROWS = 200000
+MEASURE_TYPES = {'BIGINT': pa.int64(), 'DOUBLE': pa.float64(), 'VARCHAR': pa.string(), 'BOOLEAN': pa.bool_()}
+
+# Project and month only live in the directory names, which are percent-encoded as pyarrow expects.
+PARTITIONING = ds.partitioning(pa.schema([('project', pa.string()), ('month', pa.string())]), flavor='hive')
+# Directory of records without a project, like the self-metrics totals, read back as a null project.
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# Columns of every file, null where a commit has none, so files of different runs and writers share a schema.
+# Measures keep one type whichever record form they come in, single-measure records default to DOUBLE.
+DIMENSIONS = ('group', 'author', 'parents', 'team')
+MEASURES = {'additions': 'BIGINT', 'deletions': 'BIGINT', 'id': 'VARCHAR', 'message': 'VARCHAR'}
+
+ParquetQuery = namedtuple('ParquetQuery', ['database', 'table', 'columns', 'filter'], defaults=[None])
+
+
+class ParquetMetricsStore(MetricsStore):
+    """Writes commit metrics as Parquet files under <output_dir>/<database>/<table>/project=<name>/month=<yyyy-mm>.
+
+    Each commit is one row, with its dimensions dictionary encoded and one column per measure, whether
+    the records come in one per measure or as a MULTI record. Records without a project dimension go to
+    the null project partition.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    def create_table(self, database, table, s3_bucket=None):
+        os.makedirs(self.table_dir(database, table), exist_ok=True)
+
+    def table_dir(self, database, table):
+        return os.path.join(self.output_dir, database, table)
+
+    def write_records(self, records, database, table):
+        rows = {}
+        for record in records:
+            dimensions = tuple((d['Name'], d['Value']) for d in record['Dimensions'])
+            row = rows.setdefault((dimensions, record['Time']), dict(dimensions, time=int(record['Time'])))
+            if record.get('MeasureValueType') == 'MULTI':
+                measures = record['MeasureValues']
+            else:
+                measures = [{'Name': record['MeasureName'], 'Value': record['MeasureValue'],
+                             'Type': record.get('MeasureValueType', 'DOUBLE')}]
+            for measure in measures:
+                value_type = MEASURES.get(measure['Name'], measure['Type'])
+                row[measure['Name']] = (_convert(measure['Value'], value_type), value_type)
+
+        for row in rows.values():
+            month = datetime.fromtimestamp(row['time'], timezone.utc).strftime('%Y-%m')
+            self.buffers.setdefault((database, table, row.get('project'), month), []).append(row)
+        self.buffered_rows += len(rows)
+        while self.buffered_rows > FLUSH_ROWS:
+            self._flush(max(self.buffers, key=lambda key: len(self.buffers[key])))
+
+    def flush(self):
+        for key in list(self.buffers):
+            self._flush(key)
+
+    def _flush(self, key):
+        database, table, project, month = key
+        rows = self.buffers.pop(key)
+        self.buffered_rows -= len(rows)
+        partition = NULL_PARTITION if project is None else quote(project, safe='')
+        directory = os.path.join(self.table_dir(database, table), f"project={partition}", f"month={month}")
+        os.makedirs(directory, exist_ok=True)
+        pq.write_table(_to_table(rows), os.path.join(directory, f"part-{uuid.uuid4().hex}.parquet"),
+                       compression='zstd')
+
+    def query(self, query_string, data_extractor, default_value):
+        try:
+            directory = self.table_dir(query_string.database, query_string.table)
+            if not os.path.isdir(directory):
+                return default_value
+            dataset = open_dataset(directory)
+            columns = [column for column in query_string.columns if column in dataset.schema.names]
+            table = dataset.to_table(columns=columns, filter=query_string.filter)
+            return data_extractor(table) if table.num_rows else default_value
+        except Exception as e:
+            print(f"Exception while running query: {query_string}", e)
+            return default_value
+
+    def close(self):
+        self.flush()
+
+
+class ParquetMetricsProcessor(MetricsProcessor):
+    # Files are only ever appended to, rollups can't be upserted; they are built once the export is loaded.
+    supports_daily_rollups = False
+
+    def query_latest_commit(self, args, project_name):
+        return self.query_all_latest_commits(args, ds.field('project') == project_name)
+
+    def query_commits_id(self, args, project_name):
+        return self.query_all_commits_id(args, ds.field('project') == project_name).get(project_name, ShaSet())
+
+    def query_all_latest_commits(self, args, project_filter=None):
+        def data_extractor(table):
+            grouped = table.group_by('project').aggregate([('time', 'max')])
+            return dict(zip(grouped['project'].to_pylist(), grouped['time_max'].to_pylist()))
+        query = ParquetQuery(args.database, args.table, ['project', 'time'], project_filter)
+        return self.store.query(query, data_extractor, {})
+
+    def query_all_commits_id(self, args, project_filter=None):
+        def data_extractor(table):
+            if 'id' not in table.column_names:
+                return {}
+            table = table.filter(pc.is_valid(table['id']))
+            commit_ids = {}
+            for project, commit_id in zip(table['project'].to_pylist(), table['id'].to_pylist()):
+                commit_ids.setdefault(project, ShaSet()).add(commit_id)
+            return commit_ids
+        query = ParquetQuery(args.database, args.table, ['project', 'id'], project_filter)
+        return self.store.query(query, data_extractor, {})
+
+    def migrate_to_multi_measure(self, args):
+        print("Parquet files already hold one row per commit, nothing to migrate.")
+
+    def query_stored_commits(self, args):
+        def data_extractor(table):
+            columns = {name: table[name].to_pylist() if name in table.column_names else [None] * table.num_rows
+                       for name in StoredCommit._fields}
+            return [StoredCommit(project, group, author, parents, time.timestamp(), additions or 0, deletions or 0,
+                                 commit_id or '', message)
+                    for project, group, author, parents, time, additions, deletions, commit_id, message
+                    in zip(*columns.values())]
+        yield self.store.query(ParquetQuery(args.database, args.table, list(StoredCommit._fields)), data_extractor, [])
+
+    def query_daily_rollups(self, args, project_name, since):
+        return {}
+
+
+def _convert(value, value_type):
+    if value_type == 'BIGINT':
+        return int(value)
+    if value_type == 'DOUBLE':
+        return float(value)
+    if value_type == 'BOOLEAN':
+        return value.lower() == 'true'
+    return value
+
+
+def open_dataset(directory):
+    """Dataset of a table directory with the columns of all its files, ds.dataset alone takes the first file's."""
+    dataset = ds.dataset(directory, format='parquet', partitioning=PARTITIONING)
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    if not schemas:
+        return dataset
+    # Files written before the types were fixed may hold additions and deletions as DOUBLE.
+    schema = pa.unify_schemas(schemas + [PARTITIONING.schema], promote_options='permissive')
+    return ds.dataset(directory, format='parquet', partitioning=PARTITIONING, schema=schema)
+
+
+def _to_table(rows):
+    dimensions, measures = list(DIMENSIONS), dict(MEASURES)
+    for row in rows:
+        for name, value in row.items():
+            if isinstance(value, tuple):
+                measures.setdefault(name, value[1])
+            elif name not in ('time', 'project') and name not in dimensions:
+                dimensions.append(name)
+    columns = {'time': pa.array([row['time'] for row in rows], pa.timestamp('s', tz='UTC'))}
+    for name in dimensions:
+        columns[name] = pa.array([row.get(name) for row in rows], pa.string()).dictionary_encode()
+    for name, value_type in measures.items():
+        columns[name] = pa.array([row[name][0] if name in row else None for row in rows], MEASURE_TYPES[value_type])
+    return pa.table(columns)
@@ -1,18 +1,44 @@
 import boto3
-from datetime import datetime
-from metrics_store import MetricsStore, MetricsProcessor
+import json
+import threading
+import time
+from botocore.config import Config
+from concurrent import futures
+from datetime import datetime, timezone
+from instrumentation import METRICS
+from metrics_rollup import ROLLUP_MEASURE, ROLLUP_MEASURES
+from metrics_store import MetricsStore, MetricsProcessor, StoredCommit, commit_dimensions, commit_records
+from retry_util import backoff_delay
+from sha_index import ShaSet
+
+# Amazon Timestream accepts at most 100 records per WriteRecords request.
+WRITE_BATCH_SIZE = 100
 
 
 class TimestreamMetricsStore(MetricsStore):
-    def __init__(self, region, aws_access_key, aws_access_secret):
+    def __init__(self, region, aws_access_key, aws_access_secret, write_concurrency=4, max_retries=5,
+                 dead_letter_file=None):
+        self.write_concurrency = max(write_concurrency, 1)
+        self.max_retries = max_retries
+        self.dead_letter_file = dead_letter_file
+        self.dead_letter_lock = threading.Lock()
+        # Throttling is retried by write_records with jittered backoff, not by botocore.
         self.write_client = boto3.client('timestream-write',
                                          region_name=region,
                                          aws_access_key_id=aws_access_key,
-                                         aws_secret_access_key=aws_access_secret)
+                                         aws_secret_access_key=aws_access_secret,
+                                         config=Config(max_pool_connections=max(10, self.write_concurrency),
+                                                       retries={'mode': 'standard', 'max_attempts': 1}))
         self.query_client = boto3.client('timestream-query',
                                          region_name=region,
                                          aws_access_key_id=aws_access_key,
                                          aws_secret_access_key=aws_access_secret)
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.write_concurrency,
+                                                   thread_name_prefix='timestream-writer')
+        # Partial trunk per table and trunks being written, a store is only used by the thread that built it.
+        self.trunks = {}
+        self.in_flight = set()
+        self.errors = []
 
     def create_table(self, database, table, s3_bucket=None):
         try:
@@ -39,39 +65,222 @@ class TimestreamMetricsStore(MetricsStore):
             print(f"Table {table} created successfully in database {database}.")
 
     def write_records(self, records, database, table):
-        for trunk in [records[x:x + 100] for x in range(0, len(records), 100)]:
-            print(f"Writing {len(trunk)} metrics.")
+        self.submit_records(records, database, table)
+        self.flush()
+
+    def submit_records(self, records, database, table):
+        """Cuts records into full trunks, keeping up to write_concurrency of them in flight across calls."""
+        trunk = self.trunks.setdefault((database, table), [])
+        for record in records:
+            trunk.append(record)
+            if len(trunk) >= WRITE_BATCH_SIZE:
+                self._submit(trunk, database, table)
+                trunk = self.trunks[(database, table)] = []
+
+    def flush(self):
+        trunks, self.trunks = self.trunks, {}
+        for (database, table), trunk in trunks.items():
+            if trunk:
+                self._submit(trunk, database, table)
+        done, _ = futures.wait(self.in_flight)
+        self.in_flight = set()
+        self._collect(done)
+        if self.errors:
+            error, self.errors = self.errors[0], []
+            raise error
+
+    def _submit(self, trunk, database, table):
+        if len(self.in_flight) >= self.write_concurrency:
+            done, self.in_flight = futures.wait(self.in_flight, return_when=futures.FIRST_COMPLETED)
+            self._collect(done)
+        self.in_flight.add(self.executor.submit(METRICS.bind(self._write_trunk), trunk, database, table))
+
+    def _collect(self, done):
+        self.errors.extend(f.exception() for f in done if f.exception())
+
+    def _write_trunk(self, trunk, database, table):
+        common_attributes, trunk = extract_common_attributes(trunk)
+        print(f"Writing {len(trunk)} metrics.")
+        attempt = 0
+        while True:
             try:
                 self.write_client.write_records(
                     DatabaseName=database,
                     TableName=table,
+                    CommonAttributes=common_attributes,
                     Records=trunk
                 )
+                METRICS.count('write_requests')
+                return
+            except self.write_client.exceptions.RejectedRecordsException as e:
+                # Records that are not rejected have been written, rejected ones won't succeed on retry.
+                rejected = e.response.get('RejectedRecords', [])
+                print(f"\t\t{len(rejected)} records rejected by Amazon Timestream.")
+                METRICS.count('rejected_records', len(rejected))
+                self._dead_letter(common_attributes, [(trunk[r['RecordIndex']], r.get('Reason')) for r in rejected])
+                return
+            except (self.write_client.exceptions.ThrottlingException,
+                    self.write_client.exceptions.InternalServerException) as e:
+                if attempt >= self.max_retries:
+                    print(f"\t\tGave up writing records to Amazon Timestream after {attempt} retries: {str(e)}")
+                    self._dead_letter(common_attributes, [(record, str(e)) for record in trunk])
+                    raise
+                delay = backoff_delay(attempt)
+                METRICS.count('write_retries')
+                METRICS.count('retry_wait_seconds', delay)
+                time.sleep(delay)
+                attempt += 1
             except Exception as e:
                 print(f"\t\tFailed to write records to Amazon Timestream: {str(e)}")
+                self._dead_letter(common_attributes, [(record, str(e)) for record in trunk])
+                raise
+
+    def _dead_letter(self, common_attributes, rejected):
+        if not rejected:
+            return
+        METRICS.count('failed_records', len(rejected))
+        if not self.dead_letter_file:
+            return
+        with self.dead_letter_lock, open(self.dead_letter_file, 'a') as f:
+            for record, reason in rejected:
+                dimensions = common_attributes.get('Dimensions', []) + record.get('Dimensions', [])
+                f.write(json.dumps({'Record': {**common_attributes, **record, 'Dimensions': dimensions},
+                                    'Reason': reason}) + '\n')
 
     def query(self, query_string, data_extractor, default_value):
         try:
-            response = self.query_client.query(QueryString=query_string)
-            if response['Rows']:
-                return data_extractor(response['Rows'])
+            rows = [row for page in self.query_pages(query_string) for row in page]
+            if rows:
+                return data_extractor(rows)
             else:
                 return default_value
         except Exception as e:
             print(f"Exception while running query: {query_string}", e)
             return default_value
 
+    def query_pages(self, query_string):
+        """Yields the rows of every result page of a query, following NextToken."""
+        kwargs = {'QueryString': query_string}
+        while True:
+            response = self.query_client.query(**kwargs)
+            yield response['Rows']
+            if not response.get('NextToken'):
+                return
+            kwargs['NextToken'] = response['NextToken']
+
     def close(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Failed to write records to Amazon Timestream: {str(e)}")
+        self.executor.shutdown()
         self.write_client.close()
         self.query_client.close()
 
+
+def extract_common_attributes(trunk):
+    """Moves the dimensions and time unit shared by every record of a trunk into CommonAttributes."""
+    common_dimensions = [dimension for dimension in trunk[0].get('Dimensions', [])
+                         if all(dimension in record.get('Dimensions', []) for record in trunk[1:])]
+    common_attributes = {'Dimensions': common_dimensions} if common_dimensions else {}
+    time_units = {record.get('TimeUnit') for record in trunk}
+    if len(time_units) == 1 and None not in time_units:
+        common_attributes['TimeUnit'] = time_units.pop()
+
+    records = []
+    for record in trunk:
+        dimensions = [dimension for dimension in record.get('Dimensions', []) if dimension not in common_dimensions]
+        record = {key: value for key, value in record.items()
+                  if key != 'Dimensions' and key not in common_attributes}
+        if dimensions:
+            record['Dimensions'] = dimensions
+        records.append(record)
+    return common_attributes, records
+
+
 class TimestreamMetricsProcessor(MetricsProcessor):
-    def load_latest_commit(self, args, project_name):
-        query = f"SELECT project, MAX(time) as max_time FROM \"{args.database}\".\"{args.table}\" where project = '{project_name}' AND measure_name = 'id' GROUP BY project"
+    def query_latest_commit(self, args, project_name):
+        return self.query_all_latest_commits(args, f"project = '{project_name}' AND ")
+
+    def query_commits_id(self, args, project_name):
+        return self.query_all_commits_id(args, f"project = '{project_name}' AND ").get(project_name, ShaSet())
+
+    def query_all_latest_commits(self, args, project_filter=''):
+        measure_name = 'commit' if self.multi_measure else 'id'
+        query = f"SELECT project, MAX(time) as max_time FROM \"{args.database}\".\"{args.table}\" where {project_filter}measure_name = '{measure_name}' GROUP BY project"
         data_extractor = lambda rows: {row['Data'][0]['ScalarValue']: datetime.strptime(row['Data'][1]['ScalarValue'][:-3], '%Y-%m-%d %H:%M:%S.%f') for row in rows}
         return self.store.query(query, data_extractor, {})
 
-    def get_all_commits_id(self, args, project_name):
-        query = f"SELECT measure_value::varchar FROM \"{args.database}\".\"{args.table}\" where project = '{project_name}' AND measure_name = 'id'"
-        data_extractor = lambda rows: [row['Data'][0]['ScalarValue'] for row in rows]
-        return set(self.store.query(query, data_extractor, []))
+    def query_all_commits_id(self, args, project_filter=''):
+        if self.multi_measure:
+            query = f"SELECT project, id FROM \"{args.database}\".\"{args.table}\" where {project_filter}measure_name = 'commit'"
+        else:
+            query = f"SELECT project, measure_value::varchar FROM \"{args.database}\".\"{args.table}\" where {project_filter}measure_name = 'id'"
+        commit_ids = {}
+        try:
+            # Page by page, the rows of a whole table are not kept around once their ids are in the sets.
+            for rows in self.store.query_pages(query):
+                for row in rows:
+                    commit_ids.setdefault(row['Data'][0]['ScalarValue'], ShaSet()).add(row['Data'][1]['ScalarValue'])
+        except Exception as e:
+            print(f"Exception while running query: {query}", e)
+        return commit_ids
+
+    def migrate_to_multi_measure(self, args):
+        """Rewrites the single-measure rows of the table as one 'commit' MULTI record per commit.
+
+        The original rows are left in place and age out with the table's retention.
+        """
+        migrated = 0
+        for rows in self.store.query_pages(self._single_measure_commits_query(args)):
+            records = [multi_measure_record(row) for row in rows]
+            self.store.write_records(records, args.database, args.table)
+            migrated += len(records)
+        print(f"Migrated {migrated} commits to multi-measure records.")
+
+    def query_stored_commits(self, args):
+        if self.multi_measure:
+            query = f"""SELECT project, "group", author, parents, time, additions, deletions, id, message
+            FROM "{args.database}"."{args.table}" WHERE measure_name = 'commit'"""
+        else:
+            query = self._single_measure_commits_query(args)
+        for rows in self.store.query_pages(query):
+            yield [stored_commit(row) for row in rows]
+
+    def _single_measure_commits_query(self, args):
+        return f"""SELECT project, "group", author, parents, time,
+            MAX(CASE WHEN measure_name = 'additions' THEN measure_value::double END) AS additions,
+            MAX(CASE WHEN measure_name = 'deletions' THEN measure_value::double END) AS deletions,
+            MAX(CASE WHEN measure_name = 'id' THEN measure_value::varchar END) AS id,
+            MAX(CASE WHEN measure_name = 'message' THEN measure_value::varchar END) AS message
+        FROM "{args.database}"."{args.table}"
+        WHERE measure_name IN ('additions', 'deletions', 'id', 'message')
+        GROUP BY project, "group", author, parents, time"""
+
+    def query_daily_rollups(self, args, project_name, since):
+        query = f"""SELECT "group", author, parents, to_milliseconds(time) / 1000 AS day, {', '.join(ROLLUP_MEASURES)}
+        FROM "{args.database}"."{args.rollup_table}"
+        WHERE project = '{project_name}' AND measure_name = '{ROLLUP_MEASURE}' AND time >= from_unixtime({since})"""
+        def data_extractor(rows):
+            rollups = {}
+            for row in rows:
+                group, author, parents, day, *totals = [column.get('ScalarValue') for column in row['Data']]
+                rollups[(group, author, parents, int(day))] = [int(total or 0) for total in totals]
+            return rollups
+        # Raises when the read fails, upserting this run's totals alone would replace the stored ones.
+        return data_extractor([row for page in self.store.query_pages(query) for row in page])
+
+
+def stored_commit(row):
+    project, group, author, parents, time, additions, deletions, commit_id, message = \
+        [column.get('ScalarValue') for column in row['Data']]
+    timestamp = datetime.strptime(time[:-3], '%Y-%m-%d %H:%M:%S.%f').replace(tzinfo=timezone.utc).timestamp()
+    return StoredCommit(project, group, author, parents, timestamp, int(float(additions or 0)),
+                        int(float(deletions or 0)), commit_id or '', message)
+
+
+def multi_measure_record(row):
+    commit = stored_commit(row)
+    dimensions = commit_dimensions(commit.project, commit.group, commit.author, commit.parents)
+    return next(commit_records(dimensions, commit.time, commit.additions, commit.deletions, commit.id,
+                               commit.message, multi_measure=True))
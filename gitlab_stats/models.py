@@ -1,6 +1,8 @@
 from datetime import datetime
 
 class Project:
+    __slots__ = ('id', 'name', 'full_name', 'description', 'url', 'default_branch')
+
     def __init__(self, id, name, full_name, description, url, default_branch):
         self.id = id
         self.name = name
@@ -35,32 +37,52 @@ class Project:
 from datetime import datetime
 
 class Commit:
-    def __init__(self, sha, author, date, message, parents, stats):
+    """Only what process_commit needs, without the API objects or stats dicts the commit was read from."""
+    __slots__ = ('sha', 'author', 'date', 'message', 'parent_count', 'additions', 'deletions')
+
+    def __init__(self, sha, author, date, message, parent_count, additions, deletions):
         self.sha = sha
         self.author = author
         self.date = date
         self.message = message
-        self.parents = parents
-        self.stats = stats
+        self.parent_count = parent_count
+        self.additions = additions
+        self.deletions = deletions
 
     @classmethod
     def from_github_commit(cls, github_commit):
+        stats = github_commit.stats
         return cls(
             sha=github_commit.sha,
             author=github_commit.commit.author.name,
             date=github_commit.commit.author.date,
             message=github_commit.commit.message,
-            parents=[parent.sha for parent in github_commit.parents],
-            stats=github_commit.stats.__dict__
+            parent_count=len(github_commit.parents),
+            additions=stats.additions,
+            deletions=stats.deletions
+        )
+
+    @classmethod
+    def from_github_graphql_commit(cls, node):
+        return cls(
+            sha=node['oid'],
+            author=node['author']['name'],
+            date=datetime.fromisoformat(node['author']['date']),
+            message=node['message'],
+            parent_count=len(node['parents']['nodes']),
+            additions=node['additions'],
+            deletions=node['deletions']
         )
 
     @classmethod
     def from_gitlab_commit(cls, gitlab_commit):
+        stats = gitlab_commit.stats
         return cls(
             sha=gitlab_commit.id,
             author=gitlab_commit.author_name,
             date=datetime.strptime(gitlab_commit.created_at, '%Y-%m-%dT%H:%M:%S.%f%z'),
             message=gitlab_commit.message,
-            parents=gitlab_commit.parent_ids,
-            stats=gitlab_commit.stats
+            parent_count=len(gitlab_commit.parent_ids),
+            additions=stats.get('additions', 0),
+            deletions=stats.get('deletions', 0)
         )
@@ -0,0 +1,92 @@
+import argparse
+import csv
+
+import pyarrow as pa
+
+from line_protocol import LineProtocolEncoder
+from metrics_store_parquet import open_dataset
+
+ARROW_TYPES = {pa.int64(): 'BIGINT', pa.float64(): 'DOUBLE', pa.string(): 'VARCHAR', pa.bool_(): 'BOOLEAN'}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Export Parquet commit metrics for Timestream batch load or InfluxDB import')
+    parser.add_argument('-i', '--input', required=True, help='Table directory written by the parquet store, e.g. parquet/<database>/<table>')
+    parser.add_argument('-o', '--output', required=True, help='Output file')
+    parser.add_argument('-f', '--format', required=False, choices=['csv', 'line-protocol'], help='Timestream batch load CSV or InfluxDB line protocol', default='csv')
+    parser.add_argument('--multi-measure', required=False, action='store_true', help='Write one line protocol point per commit instead of one per measure')
+    return parser.parse_args()
+
+
+def measure_types(dataset):
+    """Returns the Timestream type of each measure column, the other columns being time and dimensions."""
+    return {field.name: ARROW_TYPES[field.type] for field in dataset.schema
+            if field.name not in ('time', 'project', 'month') and not pa.types.is_dictionary(field.type)}
+
+
+def export_csv(dataset, output):
+    """Writes one row per commit, with the time in epoch seconds, for a multi-measure Timestream batch load."""
+    columns = [name for name in dataset.schema.names if name != 'month']
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        exported = 0
+        for batch in dataset.to_batches(columns=columns):
+            batch = batch.set_column(columns.index('time'), 'time', batch['time'].cast(pa.timestamp('s', tz='UTC')).cast(pa.int64()))
+            for row in zip(*(column.to_pylist() for column in batch.columns)):
+                writer.writerow(['' if value is None else value for value in row])
+            exported += batch.num_rows
+    print(f"Exported {exported} commits to {output}.")
+
+
+def export_line_protocol(dataset, output, multi_measure):
+    measures = measure_types(dataset)
+    dimensions = [name for name in dataset.schema.names if name not in ('time', 'month') and name not in measures]
+    encoder = LineProtocolEncoder()
+    with open(output, 'w') as f:
+        exported = 0
+        for batch in dataset.to_batches():
+            for row in batch.to_pylist():
+                for record in row_records(row, dimensions, measures, multi_measure):
+                    f.write(encoder.encode(record) + '\n')
+            exported += batch.num_rows
+    print(f"Exported {exported} commits to {output}.")
+
+
+def row_records(row, dimensions, measures, multi_measure):
+    """Turns a Parquet row back into the records the stores were written with."""
+    base = {
+        'Dimensions': [{'Name': name, 'Value': row[name] or ''} for name in dimensions],
+        'Time': str(int(row['time'].timestamp())),
+        'TimeUnit': 'SECONDS'
+    }
+    values = [(name, measure_value(row[name], value_type), value_type)
+              for name, value_type in measures.items() if row[name] is not None]
+    if multi_measure:
+        yield {**base, 'MeasureName': 'commit', 'MeasureValueType': 'MULTI',
+               'MeasureValues': [{'Name': name, 'Value': value, 'Type': value_type} for name, value, value_type in values]}
+    else:
+        for name, value, value_type in values:
+            yield {**base, 'MeasureName': name, 'MeasureValue': value, 'MeasureValueType': value_type}
+
+
+def measure_value(value, value_type):
+    if value_type == 'BOOLEAN':
+        return str(value).lower()
+    if value_type == 'DOUBLE' and value == int(value):
+        return str(int(value))
+    return str(value)
+
+
+def main():
+    args = parse_arguments()
+
+    dataset = open_dataset(args.input)
+
+    if args.format == 'csv':
+        export_csv(dataset, args.output)
+    else:
+        export_line_protocol(dataset, args.output, args.multi_measure)
+
+if __name__ == '__main__':
+    main()
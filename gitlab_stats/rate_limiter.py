@@ -0,0 +1,118 @@
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from instrumentation import METRICS
+from retry_util import backoff_delay
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """Token bucket shared by every fetcher thread, paced by the rate limit headers of the server.
+
+    Until the server reports its limit the bucket refills at initial_rate. Afterwards it refills at the
+    pace that spends the remaining budget, minus a reserve, by the time the limit resets, and blocks
+    until the reset once only the reserve is left.
+    """
+    def __init__(self, initial_rate=10.0, burst=20, reserve_ratio=0.05):
+        self.lock = threading.Lock()
+        self.rate = initial_rate
+        self.burst = burst
+        self.reserve_ratio = reserve_ratio
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.remaining = None
+        self.reserve = 0
+        self.reset_at = None
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.remaining is not None and self.remaining <= self.reserve and self.reset_at > time.time():
+                    delay = self.reset_at - time.time()
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            if delay >= 1:
+                print(f"Waiting {delay:.1f}s for the API rate limit.")
+            METRICS.count('rate_limit_wait_seconds', delay)
+            time.sleep(delay)
+
+    def update(self, headers):
+        limit = _header(headers, 'RateLimit-Limit', 'X-RateLimit-Limit')
+        remaining = _header(headers, 'RateLimit-Remaining', 'X-RateLimit-Remaining')
+        reset_at = _header(headers, 'RateLimit-Reset', 'X-RateLimit-Reset')
+        if remaining is None or reset_at is None:
+            return
+        with self.lock:
+            self.remaining = remaining
+            self.reset_at = reset_at
+            self.reserve = int((limit or remaining) * self.reserve_ratio)
+            window = max(reset_at - time.time(), 1.0)
+            self.rate = max((remaining - self.reserve) / window, 0.1)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """Takes a token from the shared RateLimiter before each request and retries 429 and 5xx responses."""
+    def __init__(self, limiter=None, max_attempts=5, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            response = super().send(request, **kwargs)
+            METRICS.count('api_calls')
+            if not kwargs.get('stream'):
+                METRICS.count('api_bytes', len(response.content))
+            if self.limiter is not None:
+                self.limiter.update(response.headers)
+            if not _should_retry(response) or attempt + 1 >= self.max_attempts:
+                return response
+            delay = _retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt, base=1.0, cap=60.0)
+            print(f"Retrying {request.method} {request.url} in {delay:.1f}s after HTTP {response.status_code}.")
+            response.close()
+            METRICS.count('api_retries')
+            METRICS.count('retry_wait_seconds', delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def _should_retry(response):
+    if response.status_code in RETRY_STATUSES:
+        return True
+    # GitHub answers 403 to primary and secondary rate limit violations.
+    return response.status_code == 403 and (
+        'Retry-After' in response.headers or response.headers.get('X-RateLimit-Remaining') == '0')
+
+
+def _retry_after(response):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+    reset_at = _header(response.headers, 'RateLimit-Reset', 'X-RateLimit-Reset')
+    if response.status_code in (403, 429) and reset_at is not None:
+        return max(reset_at - time.time(), 1.0)
+    return None
+
+
+def _header(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is not None and value.isdigit():
+            return int(value)
+    return None
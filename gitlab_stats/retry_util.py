@@ -0,0 +1,6 @@
+import random
+
+
+def backoff_delay(attempt, base=0.1, cap=20.0):
+    """Exponential backoff with full jitter, in seconds."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
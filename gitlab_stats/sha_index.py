@@ -0,0 +1,153 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+DIGEST_SIZE = 20
+PREFIX_SIZE = 4
+# Recent additions are kept in a small set and merged into the sorted digests once it grows past this share.
+MERGE_RATIO = 8
+MIN_PENDING = 1024
+
+
+class ShaSet:
+    """Set of hex commit SHAs kept as one sorted buffer of 20-byte digests, about 24 bytes per SHA.
+
+    A Python set of 40 character strings costs over 100 bytes per SHA. The first 4 bytes of every digest
+    are also kept in an array, so lookups and merge positions are found by bisecting it in C rather than
+    by a binary search over slices. With bloom_bits_per_sha, a Bloom filter in front of the sorted digests
+    answers most lookups of unknown SHAs without a search. SHAs that aren't 40 hex characters, like
+    SHA-256 object names, fall back to a plain set.
+    """
+    def __init__(self, shas=(), bloom_bits_per_sha=0):
+        self.digests = bytearray()
+        self.prefixes = array('I')
+        self.pending = set()
+        self.others = set()
+        self.bloom_bits_per_sha = bloom_bits_per_sha
+        self.bloom = None
+        self.update(shas)
+
+    @classmethod
+    def from_digests(cls, digests, bloom_bits_per_sha=0):
+        """Builds the set from 20-byte digests, sorted a bucket of leading bytes at a time.
+
+        Only the digests of one bucket exist as separate objects at once, the rest stay packed.
+        """
+        sha_set = cls(bloom_bits_per_sha=bloom_bits_per_sha)
+        buckets = [bytearray() for _ in range(256)]
+        for digest in digests:
+            if len(digest) == DIGEST_SIZE:
+                buckets[digest[0]] += digest
+            else:
+                sha_set.others.add(digest.hex())
+        for index, bucket in enumerate(buckets):
+            if bucket:
+                sorted_digests = sorted({bytes(bucket[offset:offset + DIGEST_SIZE])
+                                         for offset in range(0, len(bucket), DIGEST_SIZE)})
+                buckets[index] = None
+                sha_set.digests += b''.join(sorted_digests)
+        sha_set._index()
+        return sha_set
+
+    def add(self, sha):
+        digest = _digest(sha)
+        if digest is None:
+            self.others.add(sha)
+        elif not self._contains_digest(digest):
+            self.pending.add(digest)
+            if len(self.pending) >= max(MIN_PENDING, len(self.prefixes) // MERGE_RATIO):
+                self._merge()
+
+    def update(self, shas):
+        for sha in shas:
+            self.add(sha)
+
+    def __contains__(self, sha):
+        digest = _digest(sha)
+        if digest is None:
+            return sha in self.others
+        return self._contains_digest(digest)
+
+    def __len__(self):
+        return len(self.prefixes) + len(self.pending) + len(self.others)
+
+    def __iter__(self):
+        for offset in range(0, len(self.digests), DIGEST_SIZE):
+            yield self.digests[offset:offset + DIGEST_SIZE].hex()
+        yield from (digest.hex() for digest in self.pending)
+        yield from self.others
+
+    def _contains_digest(self, digest):
+        if digest in self.pending:
+            return True
+        if self.bloom is not None and not self._bloom_may_contain(digest):
+            return False
+        prefix = int.from_bytes(digest[:PREFIX_SIZE], 'big')
+        low = bisect_left(self.prefixes, prefix)
+        # Digests sharing their first 4 bytes are rare, this mostly compares a single candidate.
+        while low < len(self.prefixes) and self.prefixes[low] == prefix:
+            offset = low * DIGEST_SIZE
+            if self.digests[offset:offset + DIGEST_SIZE] == digest:
+                return True
+            low += 1
+        return False
+
+    def _position(self, digest):
+        """Index of the first digest not below digest."""
+        prefix = int.from_bytes(digest[:PREFIX_SIZE], 'big')
+        low = bisect_left(self.prefixes, prefix)
+        high = bisect_right(self.prefixes, prefix, low)
+        while low < high and self.digests[low * DIGEST_SIZE:(low + 1) * DIGEST_SIZE] < digest:
+            low += 1
+        return low
+
+    def _merge(self):
+        """Merges the sorted pending digests into the buffer in one pass, copying the runs between them."""
+        merged = bytearray()
+        start = 0
+        with memoryview(self.digests) as view:
+            for digest in sorted(self.pending):
+                position = self._position(digest) * DIGEST_SIZE
+                merged += view[start:position]
+                merged += digest
+                start = position
+            merged += view[start:]
+        self.digests = merged
+        self.pending = set()
+        self._index()
+
+    def _index(self):
+        # Bytes 0-3 of every digest, gathered with strided slices and read as big-endian unsigned ints.
+        packed = bytearray(len(self.digests) // DIGEST_SIZE * PREFIX_SIZE)
+        for byte in range(PREFIX_SIZE):
+            packed[byte::PREFIX_SIZE] = self.digests[byte::DIGEST_SIZE]
+        self.prefixes = array('I')
+        self.prefixes.frombytes(packed)
+        if sys.byteorder == 'little':
+            self.prefixes.byteswap()
+        if self.bloom_bits_per_sha:
+            self._build_bloom()
+
+    def _build_bloom(self):
+        self.bloom_size = max(len(self.prefixes) * self.bloom_bits_per_sha, 64)
+        self.bloom = bytearray((self.bloom_size + 7) // 8)
+        for offset in range(0, len(self.digests), DIGEST_SIZE):
+            for position in self._bloom_positions(self.digests[offset:offset + DIGEST_SIZE]):
+                self.bloom[position >> 3] |= 1 << (position & 7)
+
+    def _bloom_may_contain(self, digest):
+        return all(self.bloom[position >> 3] & (1 << (position & 7)) for position in self._bloom_positions(digest))
+
+    def _bloom_positions(self, digest):
+        # SHAs are uniformly distributed already, their own bytes serve as the hash functions.
+        for offset in range(0, 16, 4):
+            yield int.from_bytes(digest[offset:offset + 4], 'big') % self.bloom_size
+
+
+def _digest(sha):
+    if len(sha) != DIGEST_SIZE * 2:
+        return None
+    try:
+        return bytes.fromhex(sha)
+    except ValueError:
+        return None
@@ -0,0 +1,74 @@
+from bisect import bisect_right
+from datetime import datetime
+
+from member_team import NO_TEAM, read_json_items
+
+# Interval of a team an author stays in, ends are exclusive.
+END_OF_TIME = float('inf')
+START_OF_TIME = float('-inf')
+
+
+class TeamIndex:
+    """Team of each author over time, built from the team changes member_team.py imports.
+
+    Items are keyed by their 'author' field, the name commits are authored with, which member_team.py
+    inputs don't require; files without it are rejected rather than matching no commit. Change items
+    move an author between teams at their timestamp, snapshot items put an author in a team for the
+    whole history. Lookups bisect the author's change times; the interval found last is kept per
+    author, as the commits of a project mostly come in one author's history order.
+    """
+    def __init__(self):
+        self.changes = {}
+        self.times = {}
+        self.teams = {}
+        self.last = {}
+
+    @classmethod
+    def load(cls, paths):
+        index = cls()
+        for path in paths:
+            for item in read_json_items(path):
+                if not item.get('author'):
+                    raise ValueError(f"Team file {path} has an item without the 'author' field commits are matched "
+                                     f"by: {item}")
+                if 'timestamp' in item:
+                    time = datetime.strptime(item['timestamp'], '%Y-%m-%dT%H:%M:%S').timestamp()
+                    index.add(item['author'], time, item['old_team'], item['new_team'])
+                else:
+                    index.add(item['author'], START_OF_TIME, NO_TEAM, item.get('team'))
+        index.build()
+        print(f"Loaded team changes of {len(index.times)} authors.")
+        return index
+
+    def add(self, author, time, old_team, new_team):
+        self.changes.setdefault(author, []).append((time, old_team or NO_TEAM, new_team or NO_TEAM))
+
+    def build(self):
+        """Sorts the changes added so far into per-author arrays, the first team is the one left by the first change."""
+        for author, changes in self.changes.items():
+            changes.sort(key=lambda change: change[0])
+            self.times[author] = [time for time, _, _ in changes]
+            self.teams[author] = [changes[0][1]] + [new_team for _, _, new_team in changes]
+        self.changes = {}
+        self.last = {}
+
+    def team_at(self, author, time):
+        """Team of author at time, a datetime or epoch seconds, NO_TEAM for authors without any change."""
+        if isinstance(time, datetime):
+            time = time.timestamp()
+        last = self.last.get(author)
+        if last is not None and last[0] <= time < last[1]:
+            return last[2]
+        times = self.times.get(author)
+        if times is None:
+            return NO_TEAM
+        position = bisect_right(times, time)
+        start = times[position - 1] if position else START_OF_TIME
+        end = times[position] if position < len(times) else END_OF_TIME
+        team = self.teams[author][position]
+        # Replaced as a whole, threads sharing the index never see half an interval.
+        self.last[author] = (start, end, team)
+        return team
+
+    def __len__(self):
+        return len(self.times)
@@ -0,0 +1,13 @@
+from datetime import datetime, timedelta, timezone
+
+
+def as_utc(time):
+    """Store watermarks are naive UTC while fetched dates carry a timezone, this makes them comparable."""
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time.replace('Z', '+00:00'))
+    return time.astimezone(timezone.utc) if time.tzinfo else time.replace(tzinfo=timezone.utc)
+
+
+def within_retention(time):
+    """Amazon Timestream Table has a 10 years limit (which is configurable), you can't insert data older than 10 years."""
+    return time > datetime.now(timezone.utc) - timedelta(days=365 * 10)
@@ -0,0 +1,107 @@
+import hashlib
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ingestion_scheduler import IngestionJob
+from metrics_fetcher import is_null_sha
+
+BRANCH_PREFIX = 'refs/heads/'
+MAX_BODY_BYTES = 25 * 1024 * 1024
+
+
+class PushEvent:
+    __slots__ = ('project_id', 'project_name', 'branch', 'before', 'after', 'commit_count')
+
+    def __init__(self, project_id, project_name, branch, before, after, commit_count):
+        self.project_id = project_id
+        self.project_name = project_name
+        self.branch = branch
+        self.before = before
+        self.after = after
+        self.commit_count = commit_count
+
+    def job(self):
+        return IngestionJob(self.project_id, self.project_name, max(self.commit_count, 1),
+                            {self.branch: (self.before, self.after)})
+
+
+def verify_gitlab(headers, body, secret):
+    return hmac.compare_digest(headers.get('X-Gitlab-Token', ''), secret)
+
+
+def verify_github(headers, body, secret):
+    expected = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(headers.get('X-Hub-Signature-256', ''), expected)
+
+
+def parse_gitlab_push(payload):
+    project = payload.get('project') or {}
+    return PushEvent(str(payload.get('project_id') or project.get('id')), project.get('name'), payload['ref'],
+                     payload.get('before'), payload.get('after'),
+                     payload.get('total_commits_count', len(payload.get('commits', []))))
+
+
+def parse_github_push(payload):
+    repository = payload['repository']
+    return PushEvent(str(repository['id']), repository.get('name'), payload['ref'], payload.get('before'),
+                     payload.get('after'), len(payload.get('commits', [])))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Queues an ingestion job for each GitLab or GitHub push to a branch, after checking the shared secret."""
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            return self.respond(413, 'Payload too large')
+        body = self.rfile.read(length)
+
+        if 'X-Gitlab-Event' in self.headers:
+            event, verify, parse = self.headers['X-Gitlab-Event'], verify_gitlab, parse_gitlab_push
+            is_push = event == 'Push Hook'
+        elif 'X-GitHub-Event' in self.headers:
+            event, verify, parse = self.headers['X-GitHub-Event'], verify_github, parse_github_push
+            is_push = event == 'push'
+        else:
+            return self.respond(400, 'Not a GitLab or GitHub webhook')
+        if self.server.secret and not verify(self.headers, body, self.server.secret):
+            return self.respond(401, 'Invalid webhook secret')
+        if not is_push:
+            return self.respond(202, f"Ignored {event} event")
+
+        try:
+            push = parse(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            return self.respond(400, f"Invalid push event: {str(e)}")
+        # Tags and deleted branches bring no new commits.
+        if not push.branch.startswith(BRANCH_PREFIX) or is_null_sha(push.after):
+            return self.respond(202, 'Ignored push')
+        push.branch = push.branch[len(BRANCH_PREFIX):]
+        self.server.on_push(push)
+        self.respond(202, 'Queued')
+
+    def respond(self, status, message):
+        payload = message.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, secret, on_push):
+        super().__init__(('', port), WebhookHandler)
+        self.secret = secret
+        self.on_push = on_push
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='webhook-server', daemon=True).start()
+        print(f"Listening for push webhooks on port {self.server_address[1]}.")
+        return self
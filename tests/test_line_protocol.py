@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+from influxdb_client import Point, WritePrecision
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gitlab_stats'))
+
+from line_protocol import LineProtocolEncoder
+
+AUTHORS = ['Jane Doe', 'tab\there', 'carriage\rreturn', 'new\nline', 'form\ffeed', 'ends with\\',
+           'back\\slash', 'a,b=c', 'quote"d', '\\']
+
+
+def record(author, measure_name='commit', value='1', value_type='VARCHAR'):
+    return {
+        'Dimensions': [
+            {'Name': 'project', 'Value': 'group/project'},
+            {'Name': 'group', 'Value': 'group'},
+            {'Name': 'author', 'Value': author},
+            {'Name': 'parents', 'Value': '1'}
+        ],
+        'MeasureName': measure_name,
+        'MeasureValue': value,
+        'MeasureValueType': value_type,
+        'Time': '1700000000',
+        'TimeUnit': 'SECONDS'
+    }
+
+
+def point_line(record):
+    point = Point(record['MeasureName'])
+    for dimension in record['Dimensions']:
+        point.tag(dimension['Name'], dimension['Value'])
+    return point.field('value', record['MeasureValue']).time(int(record['Time']), WritePrecision.S).to_line_protocol()
+
+
+@pytest.mark.parametrize('author', AUTHORS)
+def test_tags_match_point(author):
+    assert LineProtocolEncoder().encode(record(author)) == point_line(record(author))
+
+
+@pytest.mark.parametrize('author', AUTHORS)
+def test_string_fields_match_point(author):
+    line = record('author', value=author)
+    assert LineProtocolEncoder().encode(line) == point_line(line)
+
+
+def test_measurement_matches_point():
+    line = record('author', measure_name='commit count\t\r')
+    assert LineProtocolEncoder().encode(line) == point_line(line)